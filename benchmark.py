@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmarks of wp_install.py.
+
+Serves a synthetic WordPress release, the version-check JSON, the checksums and salt APIs from a
+local HTTP server, replaces the MySQL admin with an in-memory stand-in, and times the
+install phases and full batch installs. Results are written as JSON and can be
+compared against a previous run with --baseline. The startup of the command line
+(the wp-install entry point) is also timed in fresh processes and checked against
+--import-budget.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import os
+import platform
+import py_compile
+import re
+import secrets
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+import wp_install as wp
+
+BENCH_VERSION = "9.9.9"
+
+WP_CONFIG_SAMPLE = '''<?php
+// ** Database settings - You can get this info from your web host ** //
+define( 'DB_NAME', 'database_name_here' );
+define( 'DB_USER', 'username_here' );
+define( 'DB_PASSWORD', 'password_here' );
+define( 'DB_HOST', 'localhost' );
+define( 'DB_CHARSET', 'utf8' );
+define( 'DB_COLLATE', '' );
+
+/**#@+
+ * Authentication unique keys and salts.
+ */
+define( 'AUTH_KEY',         'put your unique phrase here' );
+define( 'SECURE_AUTH_KEY',  'put your unique phrase here' );
+define( 'LOGGED_IN_KEY',    'put your unique phrase here' );
+define( 'NONCE_KEY',        'put your unique phrase here' );
+define( 'AUTH_SALT',        'put your unique phrase here' );
+define( 'SECURE_AUTH_SALT', 'put your unique phrase here' );
+define( 'LOGGED_IN_SALT',   'put your unique phrase here' );
+define( 'NONCE_SALT',       'put your unique phrase here' );
+/**#@-*/
+
+$table_prefix = 'wp_';
+
+define( 'WP_DEBUG', false );
+
+/* That's all, stop editing! Happy publishing. */
+
+if ( ! defined( 'ABSPATH' ) ) {
+	define( 'ABSPATH', __DIR__ . '/' );
+}
+
+require_once ABSPATH . 'wp-settings.php';
+'''
+
+def buildRelease(path, files=3000, file_size=8192):
+    """Synthetic release shaped like WordPress: wordpress/ prefix, core dirs and wp-content"""
+    dirs = ["wp-admin", "wp-admin/includes", "wp-includes", "wp-includes/js", "wp-content/themes/twentytwenty", "wp-content/plugins"]
+    stamp = (2024, 1, 1, 0, 0, 0)
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for d in ["", "wp-content/"] + [f"{d}/" for d in dirs]:
+            info = zipfile.ZipInfo(f"wordpress/{d}", stamp)
+            info.external_attr = (0o40755 << 16) | 0x10
+            zf.writestr(info, "")
+
+        def add(name, data):
+            info = zipfile.ZipInfo(f"wordpress/{name}", stamp)
+            info.external_attr = 0o100644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, data)
+
+        add("wp-config-sample.php", WP_CONFIG_SAMPLE)
+        add("wp-includes/version.php", f"<?php\n$wp_version = '{BENCH_VERSION}';\n")
+        for name in ["index.php", "wp-load.php", "wp-login.php", "wp-settings.php"]:
+            add(name, "<?php\n")
+
+        line = b"<?php /* synthetic core file */ echo 'wordpress';\n"
+        body = (line * (file_size // len(line) + 1))[:file_size]
+        for i in range(files):
+            add(f"{dirs[i % len(dirs)]}/file-{i}.php", body + str(i).encode())
+
+BENCH_LOCALIZED = ("fr_FR",)
+BENCH_LANGUAGE_PACKS = ("fr_FR", "de_DE")
+
+def buildLanguagePack(locale, files=40, file_size=16384):
+    """Synthetic core language pack, .mo/.po files at the root of the archive"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        body = (b"msgid \"synthetic\"\nmsgstr \"traduit\"\n" * (file_size // 36 + 1))[:file_size]
+        for name in [f"{locale}", f"admin-{locale}", f"admin-network-{locale}", f"continents-cities-{locale}"]:
+            zf.writestr(f"{name}.po", body)
+            zf.writestr(f"{name}.mo", body)
+        for i in range(files):
+            zf.writestr(f"{locale}-{i:032x}.json", body[:file_size // 8])
+    return(buf.getvalue())
+
+BENCH_PACKAGES = [("plugin", "akismet", "5.3"), ("plugin", "classic-editor", "1.6.5"), ("theme", "twentytwentyfour", "1.2")]
+
+def buildPackage(slug, version, files=200, file_size=4096):
+    """Synthetic plugin or theme archive, every file under a <slug>/ prefix"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f"{slug}/{slug}.php", f"<?php\n/*\nVersion: {version}\n*/\n")
+        body = (b"<?php /* synthetic package file */\n" * (file_size // 36 + 1))[:file_size]
+        for i in range(files):
+            zf.writestr(f"{slug}/inc/file-{i}.php", body + str(i).encode())
+    return(buf.getvalue())
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """Local replacement for the wordpress.org endpoints used by wp_install"""
+
+    daemon_threads = True
+
+    def __init__(self, release):
+        with open(release, "rb") as f:
+            self.release = f.read()
+        self.sha1 = hashlib.sha1(self.release).hexdigest()
+        with zipfile.ZipFile(io.BytesIO(self.release)) as zf:
+            self.checksums = {i.filename[len("wordpress/"):]: hashlib.md5(zf.read(i)).hexdigest() for i in zf.infolist() if not i.is_dir()}
+        self.packages = {(kind, slug): (version, buildPackage(slug, version)) for kind, slug, version in BENCH_PACKAGES}
+        self.package_downloads = 0
+        self.language_packs = {locale: buildLanguagePack(locale) for locale in BENCH_LANGUAGE_PACKS}
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+
+    @property
+    def base(self):
+        return(f"http://127.0.0.1:{self.server_port}")
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return(self)
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, ctype="application/octet-stream", headers=None, head=False):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _route(self, head=False):
+        srv = self.server
+        path = self.path.split("?")[0]
+
+        query = urllib.parse.parse_qs(self.path.partition("?")[2])
+
+        if path == "/core/version-check/1.7/":
+            # Like wordpress.org, a locale without a localized build gets the default offer
+            locale = query.get("locale", [""])[0]
+            localized = locale in BENCH_LOCALIZED
+            offer = {
+                "response": "upgrade", "current": BENCH_VERSION, "locale": locale if localized else "en_US",
+                "download": f"{srv.base}/release/{locale}/wordpress-{BENCH_VERSION}.zip" if localized else f"{srv.base}/release/wordpress-{BENCH_VERSION}.zip",
+                "php_version": "7.2.24", "mysql_version": "5.5.5"
+            }
+            etag = f'"{srv.sha1}-{offer["locale"]}"'
+            if self.headers.get("If-None-Match") == etag:
+                return(self._send(304, b"", headers={"ETag": etag}, head=True))
+            return(self._send(200, json.dumps({"offers": [offer]}).encode(), "application/json", {"ETag": etag}, head=head))
+
+        if path == "/secret-key/1.1/salt/":
+            keys = wp._generate_security_keys(wp.SECURITY_KEY_NAMES)
+            body = "\n".join(f"define('{k}', '{v}');" for k, v in keys.items())
+            return(self._send(200, body.encode(), "text/plain", head=head))
+
+        if path == "/core/checksums/1.0/":
+            return(self._send(200, json.dumps({"checksums": srv.checksums}).encode(), "application/json", head=head))
+
+        if path == "/translations/core/1.0/":
+            translations = [{"language": locale, "version": BENCH_VERSION, "package": f"{srv.base}/translation/core/{BENCH_VERSION}/{locale}.zip"} for locale in srv.language_packs]
+            return(self._send(200, json.dumps({"translations": translations}).encode(), "application/json", head=head))
+
+        m = re.match(r"/translation/core/[^/]+/([A-Za-z_]+)\.zip$", path)
+        if m:
+            if m.group(1) not in srv.language_packs:
+                return(self._send(404, b"not found", "text/plain", head=head))
+            return(self._send(200, srv.language_packs[m.group(1)], head=head))
+
+        m = re.match(r"/(plugin|theme)s/info/1\.2/$", path)
+        if m:
+            slug = query.get("request[slug]", [""])[0]
+            if (m.group(1), slug) not in srv.packages:
+                return(self._send(404, json.dumps({"error": f"{m.group(1)} not found"}).encode(), "application/json", head=head))
+            version = srv.packages[(m.group(1), slug)][0]
+            info = {"slug": slug, "version": version, "download_link": f"{srv.base}/{m.group(1)}/{slug}.{version}.zip"}
+            return(self._send(200, json.dumps(info).encode(), "application/json", head=head))
+
+        m = re.match(r"/(plugin|theme)/([a-z0-9_-]+)\.(.+)\.zip$", path)
+        if m:
+            version, data = srv.packages.get((m.group(1), m.group(2)), (None, None))
+            if version != m.group(3):
+                return(self._send(404, b"not found", "text/plain", head=head))
+            if not head:
+                with srv.lock:
+                    srv.package_downloads += 1
+            return(self._send(200, data, head=head))
+
+        if path.endswith(".zip.sha1"):
+            return(self._send(200, srv.sha1.encode(), "text/plain", head=head))
+
+        if path.endswith(".zip"):
+            data = srv.release
+            m = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if m is None:
+                return(self._send(200, data, headers={"Accept-Ranges": "bytes"}, head=head))
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else len(data) - 1
+            if start >= len(data):
+                return(self._send(416, b"", head=head))
+            return(self._send(206, data[start:end + 1], headers={"Accept-Ranges": "bytes", "Content-Range": f"bytes {start}-{end}/{len(data)}"}, head=head))
+
+        self._send(404, b"not found", "text/plain", head=head)
+
+    def do_GET(self):
+        self._route()
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+class FakeDbSession:
+    def __init__(self, admin):
+        self.admin = admin
+
+    def execute(self, sql, params=None):
+        time.sleep(self.admin.latency)
+        return([])
+
+    def listDatabases(self):
+        time.sleep(self.admin.latency)
+        with self.admin.lock:
+            return(sorted(self.admin.databases))
+
+    def createDatabase(self, name):
+        time.sleep(self.admin.latency)
+        with self.admin.lock:
+            if name in self.admin.databases:
+                raise wp.DbError(1007, "HY000", f"Can't create database '{name}'; database exists")
+            self.admin.databases.add(name)
+
+    def dropDatabase(self, name):
+        time.sleep(self.admin.latency)
+        with self.admin.lock:
+            self.admin.databases.discard(name)
+
+    def createUser(self, user, password, host="localhost"):
+        time.sleep(self.admin.latency)
+        with self.admin.lock:
+            self.admin.users.add((user, host))
+
+    def dropUser(self, user, host="localhost"):
+        time.sleep(self.admin.latency)
+        with self.admin.lock:
+            self.admin.users.discard((user, host))
+
+    def grantAll(self, db_name, user, host="localhost"):
+        time.sleep(self.admin.latency)
+
+    def loadIndex(self):
+        time.sleep(self.admin.latency)
+        with self.admin.lock:
+            return(wp.DbIndex(self.admin.databases, self.admin.users))
+
+class FakeDbAdmin:
+    """In-memory stand-in for DbAdmin, each statement costing `latency` seconds"""
+
+    def __init__(self, latency=0.001):
+        self.latency = latency
+        self.databases = set()
+        self.users = set()
+        self.lock = threading.Lock()
+        self.db_index = None
+
+    @contextlib.contextmanager
+    def session(self):
+        yield FakeDbSession(self)
+
+    def execute(self, sql, params=None):
+        return(FakeDbSession(self).execute(sql, params))
+
+    def listDatabases(self):
+        return(FakeDbSession(self).listDatabases())
+
+    def index(self, refresh=False):
+        if self.db_index is None or refresh:
+            self.db_index = FakeDbSession(self).loadIndex()
+        return(self.db_index)
+
+def timeit(fn, repeat, setup=None):
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return({"median": statistics.median(runs), "min": min(runs), "runs": runs})
+
+def runBenchmarks(work, sizes, repeat, files, db_latency):
+    release = os.path.join(work, "release.zip")
+    buildRelease(release, files=files)
+
+    server = StandIn(release).start()
+    wp.WP_VERSION_CHECK_URL = f"{server.base}/core/version-check/1.7/"
+    wp.WP_SALT_URL = f"{server.base}/secret-key/1.1/salt/"
+    wp.WP_CHECKSUMS_URL = f"{server.base}/core/checksums/1.0/"
+    wp.WP_DOWNLOADS_URL = server.base
+    wp.WP_PLUGIN_INFO_URL = f"{server.base}/plugins/info/1.2/"
+    wp.WP_THEME_INFO_URL = f"{server.base}/themes/info/1.2/"
+    wp.WP_TRANSLATIONS_URL = f"{server.base}/translations/core/1.0/"
+    wp.configureDbAdmin(FakeDbAdmin(db_latency))
+
+    results = {}
+    cache_dir = os.path.join(work, "cache")
+
+    def freshCache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    versions_dir = os.path.join(work, "versions")
+    results["version_check"] = timeit(lambda: wp.getWpVersion(versions=wp.VersionCache(versions_dir)), repeat * 5, lambda: shutil.rmtree(versions_dir, ignore_errors=True))
+    results["version_check_revalidate"] = timeit(lambda: wp.getWpVersion(versions=wp.VersionCache(versions_dir, ttl=0)), repeat * 5)
+    results["version_check_cached"] = timeit(lambda: wp.getWpVersion(versions=wp.VersionCache(versions_dir)), repeat * 5)
+
+    wpv = wp.getWpVersion(versions=wp.VersionCache(versions_dir))
+    dl = os.path.join(work, "download.zip")
+
+    def cleanDownload():
+        for f in [dl, f"{dl}.part"]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    results["download"] = timeit(lambda: wp.downloadFile(wpv["dlink"], dl), repeat, cleanDownload)
+    results["download_4_segments"] = timeit(lambda: wp.downloadFile(wpv["dlink"], dl, segments=4, chunk_size=64*1024), repeat, cleanDownload)
+    results["cache_fetch_cold"] = timeit(lambda: wp.ReleaseCache(cache_dir).fetch(wpv), repeat, freshCache)
+    results["cache_fetch_warm"] = timeit(lambda: wp.ReleaseCache(cache_dir).fetch(wpv), repeat * 5)
+
+    target = os.path.join(work, "extract")
+    clean = lambda: shutil.rmtree(target, ignore_errors=True)
+    results["extract"] = timeit(lambda: wp.extractArchive(release, target), repeat, clean)
+    policy = wp.PermissionPolicy()
+    results["extract_with_policy"] = timeit(lambda: wp.extractArchive(release, target, policy=policy), repeat, clean)
+    results["apply_policy_noop"] = timeit(lambda: wp.applyPolicy(target, policy), repeat * 5)
+
+    cache = wp.ReleaseCache(cache_dir)
+    tree = cache.tree(cache.fetch(wpv)[0])
+    results["deploy_tree"] = timeit(lambda: wp.deployTree(tree, target), repeat, clean)
+
+    clean()
+    wp.extractArchive(release, target)
+    db_conf = {"DB_NAME": "bench", "DB_USER": "bench", "DB_PASSWORD": "secret", "DB_HOST": "localhost"}
+    sample = os.path.join(target, "wp-config-sample.php")
+    config = os.path.join(target, "wp-config.php")
+    results["write_wp_config"] = timeit(lambda: wp.writeWpConfig(target, db_conf, {"WP_DEBUG": False}, False), repeat * 5, lambda: shutil.copyfile(sample, config))
+
+    sums = wp.fetchChecksums(BENCH_VERSION)
+    hashes_dir = os.path.join(work, "hashes")
+    results["verify_cold"] = timeit(lambda: wp.verifySite(target, sums, work), repeat, lambda: shutil.rmtree(hashes_dir, ignore_errors=True))
+    results["verify_warm"] = timeit(lambda: wp.verifySite(target, sums, work), repeat * 5)
+
+    # A locale without a localized build: default release plus the cached language pack
+    results["prepare_release_language_pack"] = timeit(lambda: wp.prepareRelease(wp.ReleaseCache(cache_dir), "de_DE", deploy="auto"), repeat * 5)
+
+    packages_dir = os.path.join(work, "packages")
+    specs = [(kind, slug, None) for kind, slug, _ in BENCH_PACKAGES]
+    results["packages_fetch_cold"] = timeit(lambda: wp.fetchPackages(wp.PackageCache(work), specs), repeat, lambda: shutil.rmtree(packages_dir, ignore_errors=True))
+    results["packages_fetch_warm"] = timeit(lambda: wp.fetchPackages(wp.PackageCache(work), specs), repeat * 5)
+    results["packages_install"] = timeit(lambda: wp.installPackages(target, specs, wp.PackageCache(work)), repeat)
+
+    for n in sizes:
+        sites_dir = os.path.join(work, "sites")
+
+        def reset():
+            shutil.rmtree(sites_dir, ignore_errors=True)
+            wp.configureDbAdmin(FakeDbAdmin(db_latency))
+
+        sites = [{"name": f"bench {i}", "path": os.path.join(sites_dir, f"site{i}")} for i in range(n)]
+        for deploy in ["extract", "auto"]:
+            def install():
+                res = wp.runManifest(sites, wp.ReleaseCache(cache_dir), jobs=min(8, n), deploy=deploy)
+                failed = [r for r in res if r["status"] != "ok"]
+                if failed:
+                    raise Exception(f"{len(failed)} installs failed: {failed[0]['message']}")
+            results[f"install_{n}_sites_{deploy}"] = timeit(install, repeat if n < 100 else 1, reset)
+
+    # One install job submitted to a warm serve daemon, from POST to finished
+    wp.configureDbAdmin(FakeDbAdmin(db_latency))
+    token = secrets.token_hex(16)
+    auth = {"Authorization": f"Bearer {token}"}
+    daemon = wp.makeServer("127.0.0.1:0", wp.Provisioner(wp.ReleaseCache(cache_dir), jobs=2), token)
+    threading.Thread(target=daemon.serve_forever, daemon=True).start()
+    api = f"http://127.0.0.1:{daemon.server_address[1]}"
+    jobs_done = []
+
+    def serveJob():
+        n = len(jobs_done)
+        jobs_done.append(n)
+        job = wp.httpClient().post(f"{api}/jobs", json={"type": "install", "name": f"bench daemon {n}", "path": os.path.join(work, "daemon", f"site{n}")}, headers=auth).json()
+        while job["finished"] is None:
+            time.sleep(0.002)
+            job = wp.httpClient().get(f"{api}/jobs/{job['id']}", headers=auth).json()
+        if job["status"] != "ok":
+            raise Exception(f"Daemon install failed: {job['error']}")
+    serveJob()
+    results["serve_install_job"] = timeit(serveJob, repeat * 3)
+    daemon.shutdown()
+
+    server.shutdown()
+    return(results)
+
+# Dependencies wp_install must only import in the code that needs them
+LAZY_MODULES = ("requests", "mysql.connector", "http.server")
+
+# Fresh processes timed by measureStartup(), the budget applies to startup_cli
+STARTUP_COMMANDS = {
+    "startup_python": ["-c", "pass"],
+    "startup_import": ["-c", "import wp_install"],
+    "startup_cli": ["wp-install", "--help"],
+    "startup_script": ["wp_install.py", "--help"]
+}
+
+def measureStartup(repeat):
+    """
+    Wall time of each STARTUP_COMMANDS in a fresh process. The commands take turns
+    so that a busy machine slows all of them alike, and the bytecode of wp_install
+    is compiled first, as the first run of wp-install would.
+    """
+    here = os.path.dirname(os.path.abspath(wp.__file__))
+    py_compile.compile(wp.__file__, doraise=True)
+
+    runs = {name: [] for name in STARTUP_COMMANDS}
+    for _ in range(repeat):
+        for name, argv in STARTUP_COMMANDS.items():
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *argv], check=True, stdout=subprocess.DEVNULL, cwd=here)
+            runs[name].append(time.perf_counter() - start)
+    return({name: {"median": statistics.median(r), "min": min(r), "runs": r} for name, r in runs.items()})
+
+def checkImportBudget(results, budget):
+    """Startup problems: cost of wp-install --help (above a bare interpreter) over budget ms, or eagerly imported dependencies"""
+    problems = []
+    cost = (results["startup_cli"]["median"] - results["startup_python"]["median"]) * 1000
+    if cost > budget:
+        problems.append(f"wp-install --help costs {cost:.1f}ms, over the {budget:.0f}ms budget")
+
+    probe = f"import sys, wp_install; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", probe], check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(wp.__file__)))
+    for mod in out.stdout.split():
+        problems.append(f"{mod} is imported when wp_install is loaded")
+    return(problems)
+
+def compareBaseline(results, baseline, tolerance):
+    regressions = []
+    for name, res in results.items():
+        ref = baseline.get("results", {}).get(name)
+        if ref is None:
+            continue
+        ratio = res["median"] / ref["median"] if ref["median"] else 1.0
+        flag = "REGRESSION" if ratio > tolerance else ""
+        print(f"  {name.ljust(28)} {ref['median']*1000:10.2f}ms -> {res['median']*1000:10.2f}ms  x{ratio:5.2f} {flag}")
+        if flag:
+            regressions.append(name)
+    return(regressions)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(add_help=True, description="Offline benchmarks of wp_install.py")
+    parser.add_argument("--sites", help="Number of sites for the full install benchmarks (comma separated)", default="1,10,100")
+    parser.add_argument("--repeat", type=int, help="Runs per benchmark (median is reported)", default=3)
+    parser.add_argument("--files", type=int, help="Files in the synthetic release", default=3000)
+    parser.add_argument("--db-latency", type=float, help="Simulated latency of each DB statement (s)", default=0.001)
+    parser.add_argument("--output", "-o", help="Write the results to this JSON file", default="benchmark.json")
+    parser.add_argument("--baseline", help="Previous results to compare against", default=None)
+    parser.add_argument("--tolerance", type=float, help="Slowdown ratio reported as a regression", default=1.25)
+    parser.add_argument("--import-budget", type=float, help="Maximum cost of wp-install --help, above a bare interpreter (ms)", default=50)
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sites.split(",") if x.strip()]
+
+    with tempfile.TemporaryDirectory(prefix="wp_install_bench_") as work:
+        os.environ["WP_INSTALL_CACHE"] = os.path.join(work, "cache")
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = runBenchmarks(work, sizes, args.repeat, args.files, args.db_latency)
+    results.update(measureStartup(max(11, args.repeat * 5)))
+
+    for name, res in results.items():
+        print(f"{name.ljust(28)} {res['median']*1000:10.2f}ms  (min {res['min']*1000:.2f}ms)")
+
+    out = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "params": {"sites": sizes, "repeat": args.repeat, "files": args.files, "db_latency": args.db_latency},
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    problems = checkImportBudget(results, args.import_budget)
+    for problem in problems:
+        wp.log(f"Startup: {problem}", "error")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        print(f"\nComparison with {args.baseline}")
+        if baseline.get("params") != out["params"]:
+            wp.log(f"The baseline was run with different parameters ({baseline.get('params')})", "warning")
+        regressions = compareBaseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            exit(1)
+
+    if problems:
+        exit(1)
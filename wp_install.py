@@ -1,21 +1,64 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import string
 import secrets
-import requests
-import mysql.connector
-from mysql.connector import Error
+import importlib
+import sys
 import platform
 import subprocess
 import unicodedata
 import os
 import re
 import zipfile
+import glob
+import fnmatch
+import tempfile
 import shutil
+import fcntl
+import pwd
+import grp
+import hashlib
+import json
+import time
+import threading
+import queue
+from contextlib import contextmanager
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+
+class _LazyModule:
+    """
+    Module imported on first attribute access. requests and mysql.connector make up
+    most of the startup time, and many commands (--help, scan, config) never use them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return(getattr(self._module, attr))
+
+requests = _LazyModule("requests")
+mysql_connector = _LazyModule("mysql.connector")
+mysql_pooling = _LazyModule("mysql.connector.pooling")
 
 WP_DL_LINK = "https://wordpress.org/latest.zip"
+WP_VERSION_CHECK_URL = "https://api.wordpress.org/core/version-check/1.7/"
+WP_SALT_URL = "https://api.wordpress.org/secret-key/1.1/salt/"
+WP_CHECKSUMS_URL = "https://api.wordpress.org/core/checksums/1.0/"
+WP_DOWNLOADS_URL = "https://downloads.wordpress.org"
+WP_PLUGIN_INFO_URL = "https://api.wordpress.org/plugins/info/1.2/"
+WP_THEME_INFO_URL = "https://api.wordpress.org/themes/info/1.2/"
+WP_TRANSLATIONS_URL = "https://api.wordpress.org/translations/core/1.0/"
+WP_CONFIG_SAMPLE_URL = "https://raw.githubusercontent.com/WordPress/WordPress/refs/heads/master/wp-config-sample.php"
+
+CACHE_DIR = os.environ.get("WP_INSTALL_CACHE", os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "wp_install"))
+VERSION_TTL = 3600
 
 WP_CONFIG_SAMPLE = '''<?php
 // ** Database settings - You can get this info from your web host ** //
@@ -58,6 +101,9 @@ if ( ! defined( 'ABSPATH' ) ) {
 require_once ABSPATH . 'wp-settings.php';
 '''
 
+class InstallError(Exception):
+    pass
+
 class Colors:
     RED = '\033[0;31m'
     GREEN = '\033[0;32m'
@@ -75,17 +121,127 @@ def ping(host):
 def log(msg, logtype="info"):
     tps = {
         "info": ["INFO", Colors.BLUE],
-        "success": ["SUCC", Color.GREEN],
-        "warning": ["WARN", Color.YELLOW],
-        "error": ["ERR", Color.RED],
+        "success": ["SUCC", Colors.GREEN],
+        "warning": ["WARN", Colors.YELLOW],
+        "error": ["ERR", Colors.RED],
     }
     if not logtype in tps:
         logtype="info"
     
     tt,cl = tps[logtype]
 
+    TRACER.mark(msg, logtype)
     print(f"{cl}[{tt}]{Colors.NC} {msg}")
 
+def _humanSize(n):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if n < 1024 or unit == "GiB":
+            return(f"{n:.1f} {unit}" if unit != "B" else f"{n} B")
+        n /= 1024
+
+class Tracer:
+    """
+    Wall time and volume of the install phases.
+
+    Disabled by default. Once enabled, every phase() block is recorded along with the
+    bytes/items the caller sets on the yielded dict, and log() messages are kept as
+    instant events, so a run can be summarised or exported as a Chrome trace.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.marks = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.events = []
+        self.marks = []
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name, **args):
+        rec = {"bytes": 0, "items": 0}
+        if not self.enabled:
+            yield rec
+            return
+
+        start = time.perf_counter()
+        error = None
+        try:
+            yield rec
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            end = time.perf_counter()
+            ev = {
+                "name": name,
+                "start": start - self.origin,
+                "duration": end - start,
+                "thread": threading.get_ident(),
+                "bytes": rec["bytes"],
+                "items": rec["items"],
+                "args": dict(args, error=error) if error else args
+            }
+            with self._lock:
+                self.events.append(ev)
+
+    def mark(self, msg, logtype="info"):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.marks.append({"msg": msg, "type": logtype, "time": time.perf_counter() - self.origin, "thread": threading.get_ident()})
+
+    def summary(self):
+        phases = {}
+        for ev in self.events:
+            ph = phases.setdefault(ev["name"], {"phase": ev["name"], "count": 0, "total": 0.0, "max": 0.0, "bytes": 0, "items": 0})
+            ph["count"] += 1
+            ph["total"] += ev["duration"]
+            ph["max"] = max(ph["max"], ev["duration"])
+            ph["bytes"] += ev["bytes"]
+            ph["items"] += ev["items"]
+        return(sorted(phases.values(), key=lambda p: -p["total"]))
+
+    def printSummary(self):
+        cols = ["phase", "count", "total", "max", "bytes", "items", "rate"]
+        rows = []
+        for p in self.summary():
+            if p["bytes"] and p["total"]:
+                rate = f"{_humanSize(p['bytes'] / p['total'])}/s"
+            elif p["items"] and p["total"]:
+                rate = f"{p['items'] / p['total']:.0f} items/s"
+            else:
+                rate = "-"
+            rows.append([p["phase"], str(p["count"]), f"{p['total']:.3f}s", f"{p['max']:.3f}s",
+                         _humanSize(p["bytes"]) if p["bytes"] else "-", str(p["items"]) if p["items"] else "-", rate])
+
+        widths = [max([len(c)] + [len(r[i]) for r in rows]) for i,c in enumerate(cols)]
+        print("  ".join(c.upper().ljust(w) for c,w in zip(cols, widths)))
+        for r in rows:
+            print("  ".join(v.ljust(w) for v,w in zip(r, widths)))
+
+    def writeTrace(self, path):
+        """Chrome trace (chrome://tracing, Perfetto) with the per-phase summary alongside"""
+        pid = os.getpid()
+        events = []
+        for ev in self.events:
+            events.append({
+                "name": ev["name"], "ph": "X", "pid": pid, "tid": ev["thread"],
+                "ts": round(ev["start"] * 1e6), "dur": round(ev["duration"] * 1e6),
+                "args": dict(ev["args"], bytes=ev["bytes"], items=ev["items"])
+            })
+        for m in self.marks:
+            events.append({"name": m["msg"], "ph": "i", "s": "t", "pid": pid, "tid": m["thread"], "ts": round(m["time"] * 1e6), "args": {"type": m["type"]}})
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "phases": self.summary()}, f, indent=1, default=str)
+
+TRACER = Tracer()
+
 def askBool(msg, default=None):
     yas = ["yes", "y", "oui", "o"]
     nas = ["no", "n", "non"]
@@ -128,6 +284,39 @@ def genPassword(length=40):
     alphabet = string.ascii_letters + string.digits + "!@#$%^&*"
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
+_ITOA64 = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+def _phpassEncode(data, count):
+    out = ""
+    i = 0
+    while i < count:
+        value = data[i]
+        i += 1
+        out += _ITOA64[value & 0x3f]
+        if i < count:
+            value |= data[i] << 8
+        out += _ITOA64[(value >> 6) & 0x3f]
+        if i >= count:
+            break
+        i += 1
+        if i < count:
+            value |= data[i] << 16
+        out += _ITOA64[(value >> 12) & 0x3f]
+        if i >= count:
+            break
+        i += 1
+        out += _ITOA64[(value >> 18) & 0x3f]
+    return(out)
+
+def phpassHash(password, count_log2=13, salt=None):
+    """Portable phpass hash ($P$), the format every WordPress version accepts in user_pass"""
+    salt = salt if salt is not None else _phpassEncode(secrets.token_bytes(6), 6)
+    password = password.encode("utf-8")
+    h = hashlib.md5(salt.encode() + password).digest()
+    for _ in range(1 << count_log2):
+        h = hashlib.md5(h + password).digest()
+    return(f"$P${_ITOA64[count_log2]}{salt}{_phpassEncode(h, 16)}")
+
 def formatName(name):
     name = name.lower()
     name = name.replace(" ", "_")
@@ -137,564 +326,3702 @@ def formatName(name):
 
     return(name)
 
-def runCommand(command, check=True, shell=True):
-    try:
-        result = subprocess.run(
-            command, 
-            shell=shell, 
-            check=check, 
-            capture_output=True, 
-            text=True
-        )
-        return result
-    except subprocess.CalledProcessError as e:
-        return(e.stderr)
-        #print(f"Erreur lors de l'exécution de la commande: {command}")
-        #print(f"Code de retour: {e.returncode}")
-        #print(f"Erreur: {e.stderr}")
-        #raise
-
-ERROR_PATTERNS = [
-    r'ERROR\s+(\d+)\s*\(([^)]+)\):\s*(.*)', 
-    r'ERROR\s+(\d+)\s*\(([A-Z0-9]+)\):\s*(.*)',
-    r'ERROR\s+(\d+):\s*(.*)',
-    r'Error\s+Code:\s*(\d+)\.\s*(.*)',
-    r'mysql:\s*\[ERROR\]\s*(\d+):\s*(.*)',
-    r'ERROR\s+(\d+)\s*\(([A-Z0-9]+)\)\s+at\s+line\s+\d+:\s*(.*)',
-    r'ERROR\s+(\d+)\s*\(([^)]+)\):\s*(.*)',
-    r'ERROR\s+(\d+)\s*\(([A-Z0-9]+)\)\s+([^:].*)'
-]
+DB_NAME_PREFIX = "wp_inst_"
+# Longest user name MySQL accepts, the database and its user share the name
+MYSQL_USER_MAX = 32
 
-def mysqlExtractStatus(error_message):
-    if not error_message:
-        return None
-    
-    for pattern in ERROR_PATTERNS:
-        match = re.search(pattern, error_message, re.IGNORECASE)
-        if match:
-            groups = match.groups()
-            
-            if len(groups) == 3:
-                error_code = int(groups[0])
-                sqlstate = groups[1]
-                message = groups[2].strip()
-            elif len(groups) == 2:
-                error_code = int(groups[0])
-                sqlstate = None
-                message = groups[1].strip()
-            else:
-                continue
-            
-            return {
-                'error_code': error_code,
-                'sqlstate': sqlstate,
-                'message': message
-            }
-    
-    return None
+def siteDbName(name):
+    """Name of the database and user of a site, InstallError if MySQL can't take it"""
+    dbn = DB_NAME_PREFIX + formatName(name)
+    if dbn == DB_NAME_PREFIX:
+        raise InstallError(f"No database name can be made of '{name}'")
+    if len(dbn) > MYSQL_USER_MAX:
+        raise InstallError(f"'{dbn}' is longer than the {MYSQL_USER_MAX} characters of a MySQL user name")
+    return(dbn)
 
-def runMysql(cmd, raiseOnError=False):
-    try:
-        result = subprocess.run(
-            f"sudo mysql -e \"{cmd}\"", 
-            shell=True,
-            check=True, 
-            capture_output=True, 
-            text=True
-        )
-        return(True, result.stdout, result.returncode)
-    except subprocess.CalledProcessError as e:
-        err = mysqlExtractStatus(e.stderr)
-        if raiseOnError:
-            print(f"MYSQL: error {err['error_code']} : {err['message']}")
-            raise
-        return(False, e.stderr, err)
+DB_ADMIN_SOCKETS = ["/var/run/mysqld/mysqld.sock", "/run/mysqld/mysqld.sock", "/var/lib/mysql/mysql.sock", "/tmp/mysql.sock"]
 
-def listDb():
-    r = runCommand(f"sudo mysql -e \"show databases;\"").stdout
-    r = r.strip().split("\n")
-    r = [x.strip().lower() for x in r if x.strip() not in ["Database", "information_schema", "performance_schema", "mysql", "sys"]]
-    return(r)
+class DbError(InstallError):
+    """MySQL error carrying the server's error code and SQLSTATE"""
 
-def createUser(db_user):
-    db_pass = genPassword(45)
+    def __init__(self, error_code, sqlstate, message):
+        super().__init__(f"MYSQL: error {error_code} : {message}")
+        self.error_code = error_code
+        self.sqlstate = sqlstate
+        self.message = message
 
-    print(f"sudo mysql -e \"create user '{db_user}'@'localhost' identified by '{db_pass}';\"")
+    @classmethod
+    def fromConnector(cls, e):
+        return(cls(e.errno, e.sqlstate, e.msg))
 
-    r = runCommand(f"sudo mysql -e \"create user '{db_user}'@'localhost' identified by '{db_pass}';\"")
-    if r.returncode!=0:
-        print(r)
-        exit()
+def quoteIdent(name):
+    return("`" + str(name).replace("`", "``") + "`")
 
-    print(f"    Created user '{db_user}' with password '{db_pass}'")
-    
-    return(db_pass)
+class DbSession:
+    """Admin statements run over a single connection"""
 
-def createDb(db_name, db_user):
-    succ,out,err = runMysql(f"create database {db_name};")
-    if not succ:
-        if err!=None:
-            code = err["error_code"]
-            msg = err["message"]
-            if code==1007:
-                print(f"The database already exists")
-            else:
-                print(f"MYSQL: error {code} : {msg}")
-        exit()
+    def __init__(self, conn):
+        self.conn = conn
 
+    def execute(self, sql, params=None):
+        try:
+            with TRACER.phase("mysql", statement=" ".join(sql.split()[:2]).upper()) as ph:
+                cur = self.conn.cursor()
+                try:
+                    cur.execute(sql, params)
+                    rows = cur.fetchall() if cur.with_rows else []
+                finally:
+                    cur.close()
+                self.conn.commit()
+                ph["items"] = len(rows)
+            return(rows)
+        except mysql_connector.Error as e:
+            raise DbError.fromConnector(e)
 
-    print(f"    Created database '{db_name}'")
-    
-    db_pass = createUser(db_user)
-
-    succ,out,err = runMysql(f"grant all privileges on {db_name}.* to '{db_user}'@'localhost';")
-    if not succ:
-        if err!=None:
-            code = err["error_code"]
-            msg = err["message"]
-            print(f"MYSQL: error {code} : {msg}")
-        exit()
+    def listDatabases(self):
+        return([r[0] for r in self.execute("SHOW DATABASES")])
 
-    print(f"    Granted all privileges on '{db_name}' to user '{db_user}'")
+    def createDatabase(self, name):
+        self.execute(f"CREATE DATABASE {quoteIdent(name)}")
 
-    return(db_pass)
+    def dropDatabase(self, name):
+        self.execute(f"DROP DATABASE {quoteIdent(name)}")
 
-def checkDbConnection(db_host, db_user, db_pass, db_name=None):
-    if not ping(db_host):
-        log(f"The host '{db_host}' is unreachable", "error")
-        return(False)
+    def createUser(self, user, password, host="localhost"):
+        self.execute("CREATE USER %s@%s IDENTIFIED BY %s", (user, host, password))
 
-    config = {
-        'host': db_host,
-        'user': db_user,
-        'password': db_pass
-    }
+    def dropUser(self, user, host="localhost"):
+        self.execute("DROP USER %s@%s", (user, host))
 
-    if db_name != None:
-        config["database"] = db_name
+    def grantAll(self, db_name, user, host="localhost"):
+        self.execute(f"GRANT ALL PRIVILEGES ON {quoteIdent(db_name)}.* TO %s@%s", (user, host))
 
-    conn = mysql.connector.connect(**config)
+    def setPassword(self, user, password, host="localhost"):
+        self.execute("ALTER USER %s@%s IDENTIFIED BY %s", (user, host, password))
 
-    print(conn.is_connected())
+    def loadIndex(self):
+        rows = self.execute(
+            "SELECT 'db', SCHEMA_NAME, NULL FROM information_schema.SCHEMATA "
+            "UNION ALL SELECT 'user', User, Host FROM mysql.user"
+        )
+        return(DbIndex([r[1] for r in rows if r[0] == "db"], [(r[1], r[2]) for r in rows if r[0] == "user"]))
 
-def getWpVersion():
-    try:
-        r = requests.get("https://api.wordpress.org/core/version-check/1.7/")
-        if r.status_code == 200:
-            data = r.json()
-            lst = data['offers'][0]
-
-            return({
-                "version": lst["current"],
-                "php_min": lst["php_version"],
-                "mysql_min": lst["mysql_version"],
-                "dlink": lst["download"]
-            })
-        else:
-            log("Failed to fetch WordPress version", "error")
-            return None
-    except Exception as e:
-        log(f"Error fetching WordPress version: {e}", "error")
-        return None
+    def listTables(self, db_name):
+        return([r[0] for r in self.execute(f"SHOW FULL TABLES FROM {quoteIdent(db_name)} WHERE Table_type = 'BASE TABLE'")])
 
+    def cloneTables(self, src, dest):
+        """Copy every table of src into dest without leaving the server, returning their count"""
+        tables = self.listTables(src)
+        for t in tables:
+            self.execute(f"CREATE TABLE {quoteIdent(dest)}.{quoteIdent(t)} LIKE {quoteIdent(src)}.{quoteIdent(t)}")
+            self.execute(f"INSERT INTO {quoteIdent(dest)}.{quoteIdent(t)} SELECT * FROM {quoteIdent(src)}.{quoteIdent(t)}")
+        return(len(tables))
 
+SYSTEM_SCHEMAS = ("information_schema", "performance_schema", "mysql", "sys")
 
+class DbIndex:
+    """
+    In-memory set of the server's databases and accounts.
 
+    Loaded with a single query (see DbSession.loadIndex) and kept up to date by
+    createDb() and dropDb(), so existence checks don't go back to the server.
+    """
 
+    def __init__(self, databases=(), users=()):
+        self.databases = {d.lower() for d in databases}
+        self.users = set(users)
+        self._lock = threading.Lock()
 
+    def __contains__(self, db_name):
+        return(db_name.lower() in self.databases)
 
+    def hasUser(self, user, host="localhost"):
+        return((user, host) in self.users)
 
+    def userDatabases(self):
+        return(sorted(d for d in self.databases if d not in SYSTEM_SCHEMAS))
 
-def writeWpConfig(wp_directory, db_config, wp_config=None, backup=True):
-    """
-    Args:
-        wp_directory (str): Répertoire WordPress
-        db_config (dict): Configuration base de données
-            {
-                'db_name': 'nom_db',
-                'db_user': 'utilisateur',
-                'db_password': 'mot_de_passe',
-                'db_host': 'localhost',
-                'db_charset': 'utf8mb4',
-                'db_collate': ''
-            }
-        wp_config (dict, optional): Configuration WordPress additionnelle
-            {
-                'table_prefix': 'wp_',
-                'debug': False,
-                'debug_log': False,
-                'wp_memory_limit': '256M',
-                'custom_constants': {'WP_CACHE': True}
-            }
-        backup (bool): Créer un backup avant modification
-    """
-    
-    if wp_config is None:
-        wp_config = {}
-    
-    config_file = os.path.join(wp_directory, 'wp-config.php')
-    sample_file = os.path.join(wp_directory, 'wp-config-sample.php')
-    
-    result = {
-        'success': False,
-        'action': '',
-        'message': '',
-        'backup_file': None
-    }
-    
-    try:
-        if os.path.exists(config_file):
-            result = _modify_existing_config(config_file, db_config, wp_config, backup)
+    def addDb(self, db_name):
+        with self._lock:
+            self.databases.add(db_name.lower())
 
-        elif os.path.exists(sample_file):
-            shutil.copyfile(sample_file, config_file)
+    def removeDb(self, db_name):
+        with self._lock:
+            self.databases.discard(db_name.lower())
 
-            result = _modify_existing_config(config_file, db_config, wp_config, False)
-            
-        else:
-            r = requests.get("https://raw.githubusercontent.com/WordPress/WordPress/refs/heads/master/wp-config-sample.php")
-            if r.status_code != 200:
-                print(f"      Failed to download the sample config file.\nUsing the static config")
-                
-                with open(config_file, "w") as f:
-                    f.write(WP_CONFIG_SAMPLE)
-            else:
-                with open(sample_file, "wb") as f:
-                    f.write(r.content)
-                
-                shutil.copyfile(sample_file, config_file)
-            
-            result = _modify_existing_config(config_file, db_config, wp_config, False)
-        
-        if result['success']:
-            validation = _validate_config(config_file)
-            if not validation['valid']:
-                result['success'] = False
-                result['message'] += f" Validation échouée: {validation['error']}"
-        
-        return result
-        
-    except Exception as e:
-        return {
-            'success': False,
-            'action': 'error',
-            'message': f'Erreur lors de la configuration: {str(e)}',
-            'backup_file': None
-        }
+    def addUser(self, user, host="localhost"):
+        with self._lock:
+            self.users.add((user, host))
 
-def _modify_existing_config(config_file, db_config, wp_config, backup):
-    """Modifier un fichier wp-config.php existant"""
-    
-    result = {
-        'success': True,
-        'action': 'modified',
-        'message': 'Configuration existante modifiée',
-        'backup_file': None
-    }
-    
-    if backup:
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_file = f"{config_file}.backup_{timestamp}"
-        shutil.copy2(config_file, backup_file)
-        result['backup_file'] = backup_file
-    
-    with open(config_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    content = _update_db_constants(content, db_config)
-    content = _update_wp_constants(content, wp_config)
-    content = _replace_security_keys(content)
-    
-    with open(config_file, 'w', encoding='utf-8') as f:
-        f.write(content)
-    
-    return result
+    def removeUser(self, user, host="localhost"):
+        with self._lock:
+            self.users.discard((user, host))
 
-def _update_db_constants(content, db_config):
-    db_constants = {}
-    for vr in ['DB_NAME','DB_USER','DB_PASSWORD','DB_HOST','DB_CHARSET','DB_COLLATE']:
-        if vr in db_config.keys():
-            db_constants[vr] = db_config[vr]
-    
-    #db_constants = {
-    #    'DB_NAME': db_config['db_name'],
-    #    'DB_USER': db_config['db_user'],
-    #    'DB_PASSWORD': db_config['db_password'],
-    #    'DB_HOST': db_config['db_host'],
-    #    'DB_CHARSET': db_config['db_charset'],
-    #    'DB_COLLATE': db_config['db_collate']
-    #}
-    
-    for constant, value in db_constants.items():
-        pattern = rf"define\s*\(\s*['\"]?{constant}['\"]?\s*,\s*['\"][^'\"]*['\"][^)]*\)\s*;"
-        replacement = f"define('{constant}', '{value}');"
-        
-        if re.search(pattern, content, re.IGNORECASE):
-            content = re.sub(pattern, replacement, content, flags=re.IGNORECASE)
-        else:
-            db_section_start = content.find("// ** Database settings")
-            if db_section_start != -1:
-                insertion_point = content.find("\n", db_section_start)
-                content = content[:insertion_point] + f"\n{replacement}" + content[insertion_point:]
-            else:
-                php_tag = content.find("<?php")
-                if php_tag != -1:
-                    insertion_point = content.find("\n", php_tag)
-                    content = content[:insertion_point] + f"\n{replacement}" + content[insertion_point:]
-    
-    return content
+class DbAdmin:
+    """
+    Pool of administrative MySQL connections.
 
-def _update_wp_constants(content, wp_config):
-    if "table_prefix" in wp_config.keys():
-        prefix_pattern = r'\$table_prefix\s*=\s*[\'"][^\'"]*[\'"];'
-        prefix_replacement = f"$table_prefix = '{wp_config['table_prefix']}';"
-        
-        if re.search(prefix_pattern, content):
-            content = re.sub(prefix_pattern, prefix_replacement, content)
-        elif "/* That's all, stop editing!" in content:
-            content = content.replace(
-                "/* That's all, stop editing",
-                f"{prefix_replacement}\n/* That's all, stop editing"
-            )
-        else:
-            ptn = r"if\s*\(\s*!\s*defined\s*\(\s*['\"]?ABSPATH['\"]?\s*\)\s*\)\s*\{"
-            m = re.search(ptn, content, re.IGNORECASE)
-            print(m)
-    
-    wp_constants = {}
-    for vr in ["WP_DEBUG","WP_DEBUG_LOG","WP_MEMORY_LIMIT"]:
-        if vr in wp_config.keys():
-            wp_constants[vr] = wp_config[vr]
-    
-    for constant, value in wp_constants.items():
-        pattern = rf"define\s*\(\s*['\"]?{constant}['\"]?\s*,\s*[^)]+\)\s*;"
-        replacement = f"define('{constant}', {value});"
-        
-        if re.search(pattern, content, re.IGNORECASE):
-            content = re.sub(pattern, replacement, content, flags=re.IGNORECASE)
-        elif "/* That's all, stop editing!" in content:
-            content = content.replace(
-                "/* That's all, stop editing!",
-                f"define('{constant}', {value});\n\n/* That's all, stop editing!"
-            )
+    Authenticates either through an option file ([client] section, like ~/.my.cnf)
+    or as `user` over the server's unix socket (auth_socket, as `sudo mysql` does).
+    """
+
+    def __init__(self, option_file=None, unix_socket=None, user="root", pool_size=4):
+        if option_file:
+            self.config = {"option_files": option_file, "option_groups": ["client"]}
         else:
-            ptn = r"if\s*\(\s*!\s*defined\s*\(\s*['\"]?ABSPATH['\"]?\s*\)\s*\)\s*\{"
-            m = re.search(ptn, content, re.IGNORECASE)
-            pos = m.start()
-            content = content[:pos] + "\n" + replacement + "\n\n" + content[pos:]
-    
-    return content
+            sock = unix_socket or next((s for s in DB_ADMIN_SOCKETS if os.path.exists(s)), DB_ADMIN_SOCKETS[0])
+            self.config = {"user": user, "unix_socket": sock}
 
-def _replace_security_keys(content):
-    key_names = [
-        'AUTH_KEY', 'SECURE_AUTH_KEY', 'LOGGED_IN_KEY', 'NONCE_KEY',
-        'AUTH_SALT', 'SECURE_AUTH_SALT', 'LOGGED_IN_SALT', 'NONCE_SALT'
-    ]
+        self.pool_size = max(1, min(pool_size, 32))
+        self._pool = None
+        self._lock = threading.Lock()
+        self.db_index = None
+        # The connector's pool raises instead of waiting when exhausted
+        self._slots = threading.BoundedSemaphore(self.pool_size)
 
-    new_keys = {}
+    def _getPool(self):
+        with self._lock:
+            if self._pool is None:
+                try:
+                    self._pool = mysql_pooling.MySQLConnectionPool(
+                        pool_name=f"wp_install_{id(self)}",
+                        pool_size=self.pool_size,
+                        **self.config
+                    )
+                except mysql_connector.Error as e:
+                    raise DbError.fromConnector(e)
+            return(self._pool)
 
-    try:
-        response = requests.get('https://api.wordpress.org/secret-key/1.1/salt/', timeout=10)
-        if response.status_code == 200:
-            r = response.text.strip()
-            for l in r.split("\n"):
-                kn = l.split("define('")[1].split("',")[0]
-                kv = l.split("');")[0].split("'")[-1]
-                new_keys[kn] = kv
-        else:
-            raise Exception("API indisponible")
-            
-    except:
-        new_keys = _generate_security_keys(key_names)
-
-    kta=[]
-    lkp = None
-    for key_name in key_names:
-        key_pattern = rf"define\s*\(\s*['\"]?{key_name}['\"]?\s*,\s*['\"][^'\"]*['\"][^)]*\)\s*;"
-        new_definition = f"define('{key_name}', '{new_keys[key_name]}');"
-
-        mtc = re.search(key_pattern, content, re.IGNORECASE)
-        if mtc:
-            lkp = mtc.end()
-            content = re.sub(key_pattern, new_definition, content, flags=re.IGNORECASE)
-        else:
-            kta.append(new_definition)
-    
-    if kta:
-        if lkp != None and lkp != -1:
-            lkp = content.find('\n', lkp)
-            if lkp != -1:
-                content = content[:lkp] + "\n" + ("\n".join(kta)) + content[lkp:]
-                return(content)
-        
-        mtc = content.find("* Authentication unique keys and salts.")
-        if mtc!=-1:
-            mtc = content.find("*/", mtc)
-            mtc = content.find('\n', mtc)
-            if mtc != -1:
-                content = content[:mtc] + "\n" + ("\n".join(kta)) + content[mtc:]
-                return(content)
-
-        if "/* That's all, stop editing!" in content:
-            defs = '\n'.join(kta)
-            content = content.replace(
-                "/* That's all, stop editing!",
-                f"{defs}\n\n/* That's all, stop editing!"
-            )
-        else:
-            ptn = r"if\s*\(\s*!\s*defined\s*\(\s*['\"]?ABSPATH['\"]?\s*\)\s*\)\s*\{"
-            m = re.search(ptn, content, re.IGNORECASE)
-            pos = m.start()
-            content = content[:pos] + "\n" + ("\n".join(kta)) + "\n\n" + content[pos:]
+    @contextmanager
+    def session(self):
+        pool = self._getPool()
+        with self._slots:
+            try:
+                conn = pool.get_connection()
+            except mysql_connector.Error as e:
+                raise DbError.fromConnector(e)
+            try:
+                yield DbSession(conn)
+            finally:
+                conn.close()
 
-    return content
+    def execute(self, sql, params=None):
+        with self.session() as s:
+            return(s.execute(sql, params))
 
-def _generate_security_keys(key_names):
-    import secrets
-    import string
-    
-    keys = {}
-    alphabet = string.ascii_letters + string.digits + "!@#$%^&*()-_=+[]{}|;:,.<>?"
-    
-    for key_name in key_names:
-        key_value = ''.join(secrets.choice(alphabet) for _ in range(64))
-        #keys_section += f"define('{key_name}', '{key_value}');\n"
-        keys[key_name] = key_value
-    
-    return keys
+    def listDatabases(self):
+        with self.session() as s:
+            return(s.listDatabases())
 
-def _validate_config(config_file):
-    """Valider le fichier de configuration"""
-    
-    try:
-        with open(config_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Vérifications de base
-        required_constants = ['DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_HOST']
-        missing_constants = []
-        
-        for constant in required_constants:
-            pattern = rf"define\s*\(\s*['\"]?{constant}['\"]?\s*,\s*['\"][^'\"]*['\"][^)]*\)\s*;"
-            if not re.search(pattern, content, re.IGNORECASE):
-                missing_constants.append(constant)
-        
-        if missing_constants:
-            return {
-                'valid': False,
-                'error': f"Constantes manquantes: {', '.join(missing_constants)}"
-            }
-        
-        # Vérifier la syntaxe PHP basique
-        if not content.strip().startswith('<?php'):
-            return {
-                'valid': False,
-                'error': "Le fichier ne commence pas par <?php"
-            }
-        
-        return {'valid': True, 'error': None}
-        
-    except Exception as e:
-        return {
-            'valid': False,
-            'error': f"Erreur de lecture: {str(e)}"
-        }
+    def index(self, refresh=False):
+        """DbIndex of the server, loaded on first use or when refresh is set"""
+        if self.db_index is None or refresh:
+            with self.session() as s:
+                self.db_index = s.loadIndex()
+        return(self.db_index)
 
+    def clientArgs(self):
+        """Options giving the mysql command line client the same admin account"""
+        if "option_files" in self.config:
+            return([f"--defaults-extra-file={self.config['option_files']}"])
+        return([f"--user={self.config['user']}", f"--socket={self.config['unix_socket']}"])
 
+_db_admin = None
+_db_admin_lock = threading.Lock()
 
+def configureDbAdmin(admin=None, **kwargs):
+    """Set the admin used by default, either a given object or a DbAdmin built from kwargs"""
+    global _db_admin
+    with _db_admin_lock:
+        _db_admin = admin if admin is not None else DbAdmin(**kwargs)
+    return(_db_admin)
 
+def getDbAdmin():
+    global _db_admin
+    with _db_admin_lock:
+        if _db_admin is None:
+            _db_admin = DbAdmin()
+        return(_db_admin)
 
-if __name__=="__main__":
-    parser = argparse.ArgumentParser(add_help=True)
-    parser.add_argument("--name", help="Nom du projet", required=False, default=None)
-    parser.add_argument("--path", help="Chemin du site WP", required=False, default=None)
-    parser.add_argument("--nodb", "-n", action="store_true", help="Ne crée pas de base de données", required=False, default=False)
-    
-    #parser.add_argument("input_path", help="File/Folder to convert")
-    #parser.add_argument("--out_directory", "-o", help="Output directory", required=False, default="out")
-    #parser.add_argument("--perimeter", help="Tenacy perimeter of the evaluation", required=False, default="perimeter_not_set")
-    #parser.add_argument("--evaluator", help="Evaluator email address", required=False, default="seifeddine.allaya-ext@vc-partner.net")
-    args = parser.parse_args()
-    print(f"Args: {args}\n")
+def listDb(admin=None):
+    admin = admin or getDbAdmin()
+    return(admin.index(refresh=True).userDatabases())
 
-    print(f"🗃️ Database Setup")
+def createUser(db_user, session):
+    db_pass = genPassword(45)
 
-    if args.name == None:
-        dbExists = askBool("Est-ce la base de données existe déjà ?", default=False)
-        if dbExists:
-            while True:
-                db_host = askText("Hôte", default="localhost")
-                db_user = askText("Utilisateur")
-                db_pass = askText("Mot de passe")
+    session.createUser(db_user, db_pass)
 
-                r = checkDbConnection(db_host, db_user, db_pass)
-                if r:
-                    break
-                else:
-                    print(f"Connection to database failed")
-        else:
-            name = askText("Nom du projet")
-    else:
-        name = args.name
-        dbExists=False
+    print(f"    Created user '{db_user}' with password '{db_pass}'")
     
-    if not dbExists:
-        db_host = "localhost"
-
-        if not args.nodb:
-            dbl = listDb()
-
-            name = formatName(name)
-            dbn = f"wp_inst_{name}"
-
-            if dbn in dbl:
-                print(f"There's already a database named '{dbn}'")
-                r = askBool("Do you want to replace it and the associated user ?", default=False)
-                if r:
-                    print(f"Dropping database '{dbn}' and its user\n")
-                    runMysql(f"drop database {dbn};", True)
-                    runMysql(f"drop user '{dbn}'@'localhost';", True)
-                else:
-                    print("Cancelling Installation\n")
-                    exit()
+    return(db_pass)
 
-            print(f"Creating objects for projet '{name}'")
+def createDb(db_name, db_user, admin=None, template=None, journal=None):
+    """
+    Create db_name and db_user with all privileges on it, returning the password.
 
-            #print(f"Creating Database 'wp_inst_{db_name}'")
-            db_pass = createDb(dbn, f"wp_inst_{name}")
+    With a journal (see InstallJournal), steps an earlier run completed are skipped
+    as long as the index still sees their objects, and objects a run left half
+    created are dropped and created again.
+    """
+    admin = admin or getDbAdmin()
+    index = admin.db_index
+    journal = journal if journal is not None else InstallJournal()
 
-    print(f"\n\n🌐 Wordpress Setup\n")
+    if not journal.has("db") and index is not None and index.hasUser(db_user):
+        raise DbError(1396, "HY000", f"The user '{db_user}' already exists")
 
-    if args.path == None:
-        ipath = askText(f"WP Installation path", "./")
-    else:
-        ipath = args.path
-    
+    with admin.session() as s:
+        if not (journal.done("db") and (index is None or db_name in index)):
+            if journal.has("db"):
+                try:
+                    s.dropDatabase(db_name)
+                except DbError:
+                    pass
+            journal.begin("db", name=db_name)
+            try:
+                s.createDatabase(db_name)
+            except DbError as e:
+                if e.error_code==1007:
+                    raise DbError(e.error_code, e.sqlstate, "The database already exists")
+                raise
 
+            if index is not None:
+                index.addDb(db_name)
+            print(f"    Created database '{db_name}'")
 
-    while True:
-        aipath = os.path.abspath(ipath)
-        print(f"Installation path: {aipath}")
+            if template is not None:
+                with TRACER.phase("db-clone", template=template) as ph:
+                    ph["items"] = s.cloneTables(template, db_name)
+                print(f"    Cloned template '{template}' into '{db_name}'")
+            journal.complete("db", name=db_name)
 
-        if not os.path.exists(aipath):
-            os.makedirs(aipath, exist_ok=True)
-            print(f"Created directory")
+        if journal.done("user") and (index is None or index.hasUser(db_user)):
+            db_pass = journal.get("user", "secret")
         else:
-            ctn = os.listdir(aipath)
-            wnb = len([1 for f in ["wp-admin","wp-content","wp-includes","wp-login.php","wp-load.php","wp-config.php","wp-settings.php"] if f in ctn])
+            if journal.has("user"):
+                try:
+                    s.dropUser(db_user)
+                except DbError:
+                    pass
+            journal.begin("user", name=db_user)
+            db_pass = createUser(db_user, s)
+            if index is not None:
+                index.addUser(db_user)
+            journal.complete("user", name=db_user, secret=db_pass)
 
-            r = False
-            for htd in ["public_html", "html"]:
-                if htd in ctn:
-                    r = askBool(f"Did you mean to use the '{htd}' directory ?", True)
-                    if r:
-                        ipath = os.path.join(ipath, "public_html")
-                        break
-            if r:
-                continue
+        if not journal.done("grant"):
+            s.grantAll(db_name, db_user)
+            journal.complete("grant")
 
-            if wnb>2:
-                r = askChoice("The selected directory appears to already contain a WP installation.\nWhat do you wish to do ?", [
+            print(f"    Granted all privileges on '{db_name}' to user '{db_user}'")
+
+    return(db_pass)
+
+def dropDb(db_name, db_user, admin=None):
+    admin = admin or getDbAdmin()
+    index = admin.db_index
+    with admin.session() as s:
+        if index is None or db_name in index:
+            s.dropDatabase(db_name)
+        if index is None or index.hasUser(db_user):
+            s.dropUser(db_user)
+    if index is not None:
+        index.removeDb(db_name)
+        index.removeUser(db_user)
+
+TEMPLATE_PREFIX = "wp_tpl_"
+
+def templateName(version, table_prefix="wp_"):
+    """Name of the template database of a WordPress version and table prefix"""
+    return(TEMPLATE_PREFIX + re.sub(r"\W", "_", f"{version}_{table_prefix.rstrip('_')}"))
+
+def makeTemplate(root, admin=None):
+    """
+    Copy the database of an installed site into the template of its version and
+    table prefix, replacing the previous one. Transients and login sessions are
+    dropped so they don't end up in every clone.
+    """
+    admin = admin or getDbAdmin()
+
+    with open(os.path.join(root, "wp-config.php"), "r", encoding="utf-8") as f:
+        cfg = WpConfig(f.read())
+    db_name = cfg.get("DB_NAME")
+    prefix = cfg.getTablePrefix() or "wp_"
+    version = readWpVersion(root)
+    if not db_name or version is None:
+        raise InstallError(f"'{root}' isn't an installed WordPress site")
+
+    tpl = templateName(version, prefix)
+    with admin.session() as s:
+        if tpl in s.listDatabases():
+            s.dropDatabase(tpl)
+        s.createDatabase(tpl)
+        with TRACER.phase("db-clone", template=tpl) as ph:
+            ph["items"] = s.cloneTables(db_name, tpl)
+        s.execute(f"DELETE FROM {quoteIdent(tpl)}.{quoteIdent(prefix + 'options')} WHERE option_name LIKE %s OR option_name LIKE %s", ("\\_transient\\_%", "\\_site\\_transient\\_%"))
+        s.execute(f"DELETE FROM {quoteIdent(tpl)}.{quoteIdent(prefix + 'usermeta')} WHERE meta_key = 'session_tokens'")
+
+    return(tpl)
+
+def patchSiteDb(db_name, table_prefix="wp_", url=None, title=None, admin_user=None, admin_email=None, admin_password=None, admin=None):
+    """Point a cloned site database at its own URL, title and administrator"""
+    admin = admin or getDbAdmin()
+    options = f"{quoteIdent(db_name)}.{quoteIdent(table_prefix + 'options')}"
+    users = f"{quoteIdent(db_name)}.{quoteIdent(table_prefix + 'users')}"
+
+    values = {"siteurl": url, "home": url, "blogname": title, "admin_email": admin_email}
+    values = {k: v for k, v in values.items() if v is not None}
+
+    with admin.session() as s:
+        for option, value in values.items():
+            s.execute(f"UPDATE {options} SET option_value = %s WHERE option_name = %s", (value, option))
+
+        fields = {"user_login": admin_user, "user_nicename": admin_user and formatName(admin_user), "display_name": admin_user, "user_email": admin_email}
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if admin_password is not None:
+            fields["user_pass"] = phpassHash(admin_password)
+        if fields:
+            # The template's first account is the administrator created at install
+            first = s.execute(f"SELECT MIN(ID) FROM {users}")[0][0]
+            sets = ", ".join(f"{quoteIdent(k)} = %s" for k in fields)
+            s.execute(f"UPDATE {users} SET {sets} WHERE ID = %s", tuple(fields.values()) + (first,))
+
+def checkDbConnection(db_host, db_user, db_pass, db_name=None):
+    if not ping(db_host):
+        log(f"The host '{db_host}' is unreachable", "error")
+        return(False)
+
+    config = {
+        'host': db_host,
+        'user': db_user,
+        'password': db_pass
+    }
+
+    if db_name != None:
+        config["database"] = db_name
+
+    conn = mysql_connector.connect(**config)
+
+    print(conn.is_connected())
+
+_http = None
+_http_lock = threading.Lock()
+
+def configureHttp(session=None, pool_size=16):
+    """
+    Share one requests.Session (and its keep-alive connections) between every
+    request the installer makes, a given one or a new one sized for pool_size
+    concurrent requests.
+    """
+    global _http
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    with _http_lock:
+        _http = session
+    return(session)
+
+def httpClient():
+    """The shared session when one is configured, the requests module otherwise"""
+    return(_http or requests)
+
+def _offerInfo(offer):
+    return({
+        "version": offer["current"],
+        "locale": offer.get("locale", "en_US"),
+        "php_min": offer.get("php_version"),
+        "mysql_min": offer.get("mysql_version"),
+        "dlink": offer["download"],
+        "checksum_link": f"{offer['download']}.sha1"
+    })
+
+class VersionCache:
+    """
+    On-disk copy of the version-check answers, one file per locale.
+
+    Answers younger than ttl seconds are used as is. Older ones are revalidated with
+    If-None-Match / If-Modified-Since, and are still used (with a warning) when
+    api.wordpress.org can't be reached. Every offer is kept, so any version listed
+    by the API can be pinned.
+    """
+
+    def __init__(self, root=CACHE_DIR, ttl=VERSION_TTL):
+        self.root = os.path.join(root, "versions")
+        self.ttl = ttl
+        # Fresh answers already read, so a long running process skips the disk too
+        self._memo = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, locale):
+        return(os.path.join(self.root, f"{locale or 'default'}.json"))
+
+    def _read(self, path):
+        try:
+            with open(path, "r") as f:
+                return(json.load(f))
+        except (FileNotFoundError, ValueError):
+            return(None)
+
+    def _write(self, path, entry):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(entry, f, indent=2)
+        os.replace(tmp, path)
+
+    def offers(self, locale=None, session=None, refresh=False):
+        """Every offer of the version-check API for locale, newest first"""
+        entry = self._memo.get(locale)
+        if entry and not refresh and time.time() - entry["fetched"] < self.ttl:
+            return(entry["offers"])
+
+        path = self._path(locale)
+        with fileLock(f"{path}.lock"):
+            entry = self._read(path)
+            if entry and not refresh and time.time() - entry["fetched"] < self.ttl:
+                return(entry["offers"])
+
+            headers = {}
+            if entry and entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry and entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+            http = session or httpClient()
+            try:
+                with TRACER.phase("version-check", locale=locale):
+                    r = http.get(WP_VERSION_CHECK_URL, params={"locale": locale} if locale else None, headers=headers, timeout=10)
+                if r.status_code == 304 and entry:
+                    entry["fetched"] = time.time()
+                else:
+                    r.raise_for_status()
+                    entry = {
+                        "fetched": time.time(),
+                        "etag": r.headers.get("ETag"),
+                        "last_modified": r.headers.get("Last-Modified"),
+                        "offers": r.json()["offers"]
+                    }
+                self._write(path, entry)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                if not entry:
+                    raise InstallError(f"Failed to fetch WordPress version information: {e}")
+                age = int(time.time() - entry["fetched"])
+                log(f"Version check failed ({e}), using the answer cached {age // 60} min ago", "warning")
+                return(entry["offers"])
+
+        self._memo[locale] = entry
+        return(entry["offers"])
+
+    def lookup(self, locale=None, version=None, session=None, refresh=False):
+        """getWpVersion() info of the latest offer, or of version when it is pinned"""
+        offers = self.offers(locale, session, refresh)
+        candidates = [o for o in offers if not locale or o.get("locale") == locale] or offers
+        if not candidates:
+            raise InstallError("The version-check API returned no offer")
+
+        latest = candidates[0]
+        if version is None:
+            return(_offerInfo(latest))
+
+        for offer in candidates:
+            if offer.get("current") == version:
+                return(_offerInfo(offer))
+
+        # Older releases aren't offered anymore but keep the same download naming
+        dlink = latest["download"].replace(f"wordpress-{latest['current']}", f"wordpress-{version}")
+        if dlink == latest["download"]:
+            raise InstallError(f"WordPress {version} isn't available for locale {locale or 'en_US'}")
+        return(_offerInfo({"current": version, "locale": latest.get("locale"), "download": dlink}))
+
+def getWpVersion(locale=None, version=None, versions=None):
+    try:
+        return((versions or VersionCache()).lookup(locale, version))
+    except Exception as e:
+        log(f"Error fetching WordPress version: {e}", "error")
+        return None
+
+def _bodyLength(r):
+    """Length of the body a response announces, None when unknown or encoded"""
+    length = r.headers.get("Content-Length", "")
+    if r.headers.get("Content-Encoding", "identity") != "identity" or not length.isdigit():
+        return(None)
+    return(int(length))
+
+def _rangeTotal(r):
+    """Full size of the resource from a Content-Range header, None when unknown"""
+    total = r.headers.get("Content-Range", "").rpartition("/")[2]
+    return(int(total) if total.isdigit() else None)
+
+class _SourceChanged(InstallError):
+    """The resource changed since the parts being resumed were downloaded"""
+
+def _validator(r):
+    """Strong ETag, or else Last-Modified, of a response, to resume with If-Range"""
+    etag = r.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return(etag)
+    return(r.headers.get("Last-Modified"))
+
+def _readValidator(path):
+    try:
+        with open(path, "r") as f:
+            return(f.read().strip() or None)
+    except FileNotFoundError:
+        return(None)
+
+def _writeValidator(path, validator):
+    if validator is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w") as f:
+        f.write(validator)
+
+def _fetchRange(http, url, path, start=0, end=None, chunk_size=1024*1024, timeout=30, size=None, retry=True, validator_file=None):
+    """
+    Download bytes [start, end] of url into path, resuming from what path already holds.
+
+    Resumed bytes are only kept with the validator stored in validator_file, sent as
+    If-Range: a full answer replaces them, and a full answer to a range other than
+    the whole file raises _SourceChanged. What path ends up holding is checked
+    against the expected length (from end, size or the response headers). On a
+    mismatch, or a 416 on a resumed file that isn't known to be complete, path is
+    removed and the range downloaded again once.
+    """
+    have = os.path.getsize(path) if os.path.exists(path) else 0
+    validator = _readValidator(validator_file) if validator_file is not None else None
+    expected = end - start + 1 if end is not None else (size - start if size is not None else None)
+    if have and validator_file is not None and validator is None:
+        # Nothing to check the leftover bytes against
+        os.remove(path)
+        have = 0
+    if expected is not None and have == expected:
+        return(0)
+    if expected is not None and have > expected:
+        os.remove(path)
+        have = 0
+
+    headers = {}
+    if have or start or end is not None:
+        headers["Range"] = f"bytes={start + have}-{'' if end is None else end}"
+        if validator is not None:
+            headers["If-Range"] = validator
+
+    written = 0
+    with http.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 416 and have and end is None:
+            # Nothing left past what we already have, if that is the whole file
+            if _rangeTotal(r) == start + have:
+                return(0)
+            # Can't match any size, so the check below starts over
+            expected = -1
+        else:
+            r.raise_for_status()
+
+            length = _bodyLength(r)
+            if r.status_code == 206:
+                mode = "ab"
+                if expected is None:
+                    total = _rangeTotal(r)
+                    expected = total - start if total is not None else (have + length if length is not None else None)
+            elif start or end is not None:
+                if "If-Range" in headers:
+                    raise _SourceChanged(f"{url} changed since its download started")
+                raise Exception(f"The server ignored the range request for {url}")
+            else:
+                # A new download, or the resource changed: what path held is replaced
+                mode = "wb"
+                if expected is None:
+                    expected = length
+                if validator_file is not None:
+                    _writeValidator(validator_file, _validator(r))
+
+            with open(path, mode) as f:
+                for chunk in r.iter_content(chunk_size):
+                    f.write(chunk)
+                    written += len(chunk)
+
+    if expected is not None and os.path.getsize(path) != expected:
+        os.remove(path)
+        if not retry:
+            raise InstallError(f"The download of {url} doesn't have the expected size")
+        return(written + _fetchRange(http, url, path, start, end, chunk_size, timeout, size, False, validator_file))
+    return(written)
+
+def _dropParts(part):
+    """Remove '<dest>.part', its segments and its validator"""
+    for p in glob.glob(glob.escape(part) + "*"):
+        os.remove(p)
+
+def _downloadParts(http, url, part, segments, chunk_size, timeout):
+    vfile = f"{part}.validator"
+    size = None
+    if segments > 1:
+        h = http.head(url, allow_redirects=True, timeout=timeout)
+        if h.status_code == 200 and h.headers.get("Accept-Ranges", "").lower() == "bytes":
+            size = _bodyLength(h) or None
+            url = h.url
+            current = _validator(h)
+            if current != _readValidator(vfile):
+                _dropParts(part)
+                _writeValidator(vfile, current)
+
+    # A '.part' left by a single stream download is resumed as such
+    if size is None or size < segments * chunk_size or os.path.exists(part):
+        return(_fetchRange(http, url, part, chunk_size=chunk_size, timeout=timeout, size=size, validator_file=vfile))
+
+    step = size // segments
+    bounds = [(i * step, size - 1 if i == segments - 1 else (i + 1) * step - 1) for i in range(segments)]
+    parts = [f"{part}{i}" for i in range(segments)]
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        futures = [pool.submit(_fetchRange, http, url, p, s, e, chunk_size, timeout, validator_file=vfile) for p,(s,e) in zip(parts, bounds)]
+        written = sum(f.result() for f in futures)
+
+    with open(part, "wb") as out:
+        for p in parts:
+            with open(p, "rb") as f:
+                shutil.copyfileobj(f, out, chunk_size)
+    for p in parts:
+        os.remove(p)
+    if os.path.getsize(part) != size:
+        os.remove(part)
+        raise InstallError(f"The download of {url} doesn't have the expected size")
+    return(written)
+
+def downloadFile(url, dest, segments=1, chunk_size=1024*1024, session=None, timeout=30, sha1=None):
+    """
+    Stream url to dest without holding it in memory.
+
+    Data goes to '<dest>.part' (or one '<dest>.partN' per segment) and is only renamed
+    to dest once complete, so an interrupted run resumes where it stopped, as long
+    as the server still has the same ETag or Last-Modified. If the resource changed
+    meanwhile, the parts are dropped and the download starts over once. With sha1,
+    the merged file is checked against it before the rename.
+    Returns the number of bytes transferred by this call.
+    """
+    http = session or httpClient()
+    part = f"{dest}.part"
+
+    with TRACER.phase("download", url=url, segments=segments) as ph:
+        try:
+            written = _downloadParts(http, url, part, segments, chunk_size, timeout)
+        except _SourceChanged:
+            _dropParts(part)
+            written = _downloadParts(http, url, part, segments, chunk_size, timeout)
+
+        if sha1 is not None:
+            got = fileHash(part)
+            if got != sha1:
+                _dropParts(part)
+                raise InstallError(f"Checksum mismatch for {url}: expected {sha1}, got {got}")
+        os.replace(part, dest)
+        _dropParts(part)
+        ph["bytes"] = written
+    return(written)
+
+def fileHash(path, algo="sha1", chunk_size=1024*1024):
+    h = hashlib.new(algo)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return(h.hexdigest())
+
+@contextmanager
+def fileLock(path):
+    """Exclusive advisory lock shared by every process using the same lock file"""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _publishedChecksum(url, session=None):
+    http = session or httpClient()
+    try:
+        r = http.get(url, timeout=10)
+        if r.status_code == 200:
+            m = re.search(r"\b([0-9a-fA-F]{40})\b", r.text)
+            if m:
+                return(m.group(1).lower())
+    except Exception:
+        pass
+    return(None)
+
+class ReleaseCache:
+    """
+    Local store of WordPress release archives shared by every install on the host.
+
+    Archives are stored by content (releases/<sha1>.zip) and looked up through
+    index.json, keyed by '<version>-<locale>'. Every entry is checked against the
+    published sha1 before being indexed, and the least recently used entries are
+    evicted once max_entries or max_bytes is exceeded. The version-check answers are
+    cached next to them (see VersionCache).
+    """
+
+    def __init__(self, root=CACHE_DIR, max_entries=None, max_bytes=None, version_ttl=VERSION_TTL):
+        self.root = root
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.versions = VersionCache(root, version_ttl)
+
+        self.releases = os.path.join(root, "releases")
+        self.trees = os.path.join(root, "trees")
+        self.sums = os.path.join(root, "checksums")
+        self.tmp = os.path.join(root, "tmp")
+        self.index_file = os.path.join(root, "index.json")
+        self.lock_file = os.path.join(root, ".lock")
+
+        os.makedirs(self.releases, exist_ok=True)
+        os.makedirs(self.trees, exist_ok=True)
+        os.makedirs(self.sums, exist_ok=True)
+        os.makedirs(self.tmp, exist_ok=True)
+
+    @staticmethod
+    def key(version, locale="en_US"):
+        return(f"{version}-{locale or 'en_US'}")
+
+    def _readIndex(self):
+        try:
+            with open(self.index_file, "r") as f:
+                return(json.load(f))
+        except (FileNotFoundError, ValueError):
+            return({})
+
+    def _writeIndex(self, index):
+        tmp = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.index_file)
+
+    def _path(self, sha1):
+        return(os.path.join(self.releases, f"{sha1}.zip"))
+
+    def get(self, version, locale="en_US", verify=False):
+        """Path of the cached archive, or None if it is missing or doesn't match its index entry"""
+        key = self.key(version, locale)
+        with fileLock(self.lock_file):
+            index = self._readIndex()
+            entry = index.get(key)
+            if entry is None:
+                return(None)
+
+            path = self._path(entry["sha1"])
+            if not os.path.exists(path) or os.path.getsize(path) != entry["size"] or (verify and fileHash(path) != entry["sha1"]):
+                del index[key]
+                self._writeIndex(index)
+                return(None)
+
+            entry["last_used"] = time.time()
+            self._writeIndex(index)
+        return(path)
+
+    def put(self, version, locale, archive, expected_sha1=None, checked=False):
+        """
+        Move a downloaded archive into the cache after checking it against expected_sha1,
+        unless checked tells it already was (see downloadFile).
+        """
+        with TRACER.phase("checksum") as ph:
+            sha1 = expected_sha1 if checked else fileHash(archive)
+            ph["bytes"] = os.path.getsize(archive)
+        if expected_sha1 is not None and sha1 != expected_sha1:
+            os.remove(archive)
+            raise Exception(f"Checksum mismatch for WordPress {version} ({locale}): expected {expected_sha1}, got {sha1}")
+
+        with zipfile.ZipFile(archive) as zf:
+            bad = zf.testzip()
+        if bad is not None:
+            os.remove(archive)
+            raise zipfile.BadZipFile(f"Corrupted member '{bad}' in WordPress {version} ({locale})")
+
+        path = self._path(sha1)
+        with fileLock(self.lock_file):
+            os.replace(archive, path)
+            index = self._readIndex()
+            index[self.key(version, locale)] = {
+                "version": version,
+                "locale": locale,
+                "sha1": sha1,
+                "size": os.path.getsize(path),
+                "verified": expected_sha1 is not None,
+                "added": time.time(),
+                "last_used": time.time()
+            }
+            self._writeIndex(index)
+            self._evict(index, keep=self.key(version, locale))
+        return(path)
+
+    def fetch(self, wpv, segments=1, session=None):
+        """Cached archive for a getWpVersion() offer, downloading and verifying it when needed"""
+        version, locale = wpv["version"], wpv.get("locale", "en_US")
+
+        path = self.get(version, locale)
+        if path is not None:
+            return(path, False)
+
+        key = self.key(version, locale)
+        # Only one process downloads a given release, the others wait and reuse it
+        with fileLock(os.path.join(self.tmp, f"{key}.lock")):
+            path = self.get(version, locale)
+            if path is not None:
+                return(path, False)
+
+            expected = None
+            if wpv.get("checksum_link"):
+                expected = _publishedChecksum(wpv["checksum_link"], session)
+                if expected is None:
+                    log(f"No published checksum for WordPress {version} ({locale}), the archive is only checked for zip integrity", "warning")
+
+            archive = os.path.join(self.tmp, f"{key}.zip")
+            downloadFile(wpv["dlink"], archive, segments=segments, session=session, sha1=expected)
+            return(self.put(version, locale, archive, expected, checked=expected is not None), True)
+
+    def tree(self, archive, workers=None, language=None):
+        """
+        Read-only extracted core tree of a cached archive, built once and shared by
+        deployments. With a language ({"locale", "archive"}) the language pack is
+        extracted into wp-content/languages of a separate tree.
+        """
+        sha1 = os.path.splitext(os.path.basename(archive))[0]
+        name = f"{sha1}-{language['locale']}" if language else sha1
+        path = os.path.join(self.trees, name)
+        if os.path.isdir(path):
+            return(path)
+
+        with fileLock(os.path.join(self.tmp, f"{name}.tree.lock")):
+            if os.path.isdir(path):
+                return(path)
+
+            build = f"{path}.{os.getpid()}.tmp"
+            if os.path.exists(build):
+                shutil.rmtree(build)
+            extractArchive(archive, build, workers=workers)
+            if language:
+                extractArchive(language["archive"], os.path.join(build, "wp-content", "languages"), strip="", workers=workers)
+
+            for dirpath, _, filenames in os.walk(build):
+                for fn in filenames:
+                    fp = os.path.join(dirpath, fn)
+                    os.chmod(fp, os.stat(fp).st_mode & ~0o222)
+            os.rename(build, path)
+        return(path)
+
+    def checksums(self, archive, strip="wordpress/"):
+        """{relative path: md5} of the files of a cached archive, computed once"""
+        sha1 = os.path.splitext(os.path.basename(archive))[0]
+        path = os.path.join(self.sums, f"{sha1}.json")
+        try:
+            with open(path, "r") as f:
+                return(json.load(f))
+        except (FileNotFoundError, ValueError):
+            pass
+
+        sums = {}
+        with TRACER.phase("checksum", archive=sha1) as ph, zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.startswith(strip):
+                    continue
+                h = hashlib.md5()
+                with zf.open(info) as f:
+                    for chunk in iter(lambda: f.read(1024*1024), b""):
+                        h.update(chunk)
+                sums[info.filename[len(strip):]] = h.hexdigest()
+                ph["bytes"] += info.file_size
+            ph["items"] = len(sums)
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(sums, f)
+        os.replace(tmp, path)
+        return(sums)
+
+    def _usePath(self, sha1):
+        return(os.path.join(self.tmp, f"{sha1}.use"))
+
+    def hold(self, archive):
+        """
+        Shared lock keeping a cached archive and its trees from being evicted while
+        the returned file stays open, or None when the archive is already gone.
+        """
+        sha1 = os.path.splitext(os.path.basename(archive))[0]
+        with fileLock(self.lock_file):
+            if not os.path.exists(archive):
+                return(None)
+            f = open(self._usePath(sha1), "a")
+            fcntl.flock(f, fcntl.LOCK_SH)
+        return(f)
+
+    def evict(self):
+        with fileLock(self.lock_file):
+            self._evict(self._readIndex())
+
+    def _evict(self, index, keep=None):
+        # Caller must hold the cache lock. The keep entry and archives held by a
+        # deployment (see hold()) are never evicted.
+        entries = sorted(index.items(), key=lambda kv: kv[1]["last_used"])
+        used = {e["sha1"]: e["size"] for _,e in entries}
+
+        def overBudget():
+            if self.max_entries is not None and len(index) > self.max_entries:
+                return(True)
+            return(self.max_bytes is not None and sum(used.values()) > self.max_bytes)
+
+        for key, entry in entries:
+            if not overBudget():
+                break
+            if key == keep:
+                continue
+            shared = any(e["sha1"] == entry["sha1"] for k, e in index.items() if k != key)
+            if shared:
+                del index[key]
+                continue
+
+            with open(self._usePath(entry["sha1"]), "a") as use:
+                try:
+                    fcntl.flock(use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                del index[key]
+                used.pop(entry["sha1"], None)
+                try:
+                    os.remove(self._path(entry["sha1"]))
+                except FileNotFoundError:
+                    pass
+                for tree in [entry["sha1"]] + [t for t in os.listdir(self.trees) if t.startswith(f"{entry['sha1']}-")]:
+                    shutil.rmtree(os.path.join(self.trees, tree), ignore_errors=True)
+                try:
+                    os.remove(os.path.join(self.sums, f"{entry['sha1']}.json"))
+                except FileNotFoundError:
+                    pass
+
+        self._writeIndex(index)
+
+
+
+
+
+
+PACKAGE_KINDS = ("plugin", "theme")
+_PACKAGE_SLUG = re.compile(r"^[a-z0-9][a-z0-9_-]*$")
+
+def packageSpec(kind, spec):
+    """(kind, slug, version or None) of 'slug', 'slug@version' or {"slug", "version"}"""
+    if isinstance(spec, dict):
+        slug, version = spec.get("slug"), spec.get("version")
+    else:
+        slug, _, version = str(spec).partition("@")
+    if kind not in PACKAGE_KINDS or not slug or not _PACKAGE_SLUG.match(slug):
+        raise InstallError(f"Invalid {kind} '{spec}'")
+    return((kind, slug, version or None))
+
+class PackageCache:
+    """
+    Local store of plugin, theme and core language pack zips from wordpress.org,
+    shared by every site.
+
+    Packages are stored as <root>/packages/<kind>/<slug>/<version>.zip and language
+    packs as <root>/packages/translation/<version>/<locale>.zip. A package
+    without a version is resolved to the latest one through the info API once per
+    process, and concurrent fetches of the same package wait for a single download.
+    """
+
+    def __init__(self, root=CACHE_DIR):
+        self.root = os.path.join(root, "packages")
+        self._latest = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def resolve(self, kind, slug, session=None):
+        """(version, download URL) of the latest release of a package"""
+        with self._lock:
+            if (kind, slug) in self._latest:
+                return(self._latest[(kind, slug)])
+
+        http = session or httpClient()
+        url = WP_PLUGIN_INFO_URL if kind == "plugin" else WP_THEME_INFO_URL
+        with TRACER.phase("package-info", slug=slug):
+            r = http.get(url, params={"action": f"{kind}_information", "request[slug]": slug}, timeout=10)
+        if r.status_code == 404:
+            raise InstallError(f"Unknown {kind} '{slug}'")
+        r.raise_for_status()
+        info = r.json()
+        if "error" in info or not info.get("version"):
+            raise InstallError(f"Unknown {kind} '{slug}'")
+
+        found = (info["version"], info.get("download_link") or f"{WP_DOWNLOADS_URL}/{kind}/{slug}.{info['version']}.zip")
+        with self._lock:
+            self._latest[(kind, slug)] = found
+        return(found)
+
+    def fetch(self, kind, slug, version=None, session=None):
+        """(path, version) of the cached package, downloading and checking it when needed"""
+        if version is None:
+            version, url = self.resolve(kind, slug, session)
+        else:
+            url = f"{WP_DOWNLOADS_URL}/{kind}/{slug}.{version}.zip"
+
+        path = os.path.join(self.root, kind, slug, f"{version}.zip")
+        return(self._store(path, lambda: url, f"{kind} '{slug}' {version}", session), version)
+
+    def languagePack(self, version, locale, session=None):
+        """Path of the cached core language pack of locale for WordPress version"""
+        path = os.path.join(self.root, "translation", version, f"{locale}.zip")
+        return(self._store(path, lambda: self._languagePackUrl(version, locale, session), f"{locale} language pack for WordPress {version}", session))
+
+    def _languagePackUrl(self, version, locale, session=None):
+        http = session or httpClient()
+        with TRACER.phase("translations", locale=locale):
+            r = http.get(WP_TRANSLATIONS_URL, params={"version": version}, timeout=10)
+        r.raise_for_status()
+        for t in r.json().get("translations", []):
+            if t.get("language") == locale and t.get("package"):
+                return(t["package"])
+        raise InstallError(f"No {locale} language pack for WordPress {version}")
+
+    def _store(self, path, url, what, session=None):
+        # url is only called when the archive isn't cached yet
+        if os.path.exists(path):
+            return(path)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with fileLock(f"{path}.lock"):
+            if os.path.exists(path):
+                return(path)
+
+            # A stable name, so that an interrupted download resumes from its '.part'
+            tmp = f"{path}.tmp"
+            try:
+                if not os.path.exists(tmp):
+                    downloadFile(url(), tmp, session=session)
+            except requests.HTTPError as e:
+                raise InstallError(f"Failed to download {what}: {e}")
+            with zipfile.ZipFile(tmp) as zf:
+                bad = zf.testzip()
+            if bad is not None:
+                os.remove(tmp)
+                raise InstallError(f"Corrupt archive for {what} ({bad})")
+            os.replace(tmp, path)
+        return(path)
+
+def _zipMemberPath(dest, name, strip):
+    """Target path of a zip member below dest, or None if it is outside strip or escapes dest"""
+    if not name.startswith(strip):
+        return(None)
+    rel = name[len(strip):]
+    if rel == "" or rel.startswith("/") or ".." in rel.split("/"):
+        return(None)
+    return(os.path.join(dest, *rel.rstrip("/").split("/")))
+
+def _zipMemberTime(info):
+    return(time.mktime(info.date_time + (0, 0, -1)))
+
+def _extractMembers(zip_path, jobs, chunk_size, policy=None, root=None):
+    written = 0
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        for info, path in jobs:
+            with zf.open(info) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst, chunk_size)
+                if policy is not None:
+                    policy.fixFd(dst.fileno(), os.path.relpath(path, root))
+
+            mode = (info.external_attr >> 16) & 0o7777
+            if mode and policy is None:
+                os.chmod(path, mode)
+            mtime = _zipMemberTime(info)
+            os.utime(path, (mtime, mtime))
+            written += info.file_size
+    return(written)
+
+def extractArchive(zip_path, dest, strip="wordpress/", workers=None, chunk_size=1024*1024, policy=None, root=None):
+    """
+    Extract the members of zip_path found under strip straight into dest.
+
+    Files are spread over a thread pool, each worker holding its own handle on the
+    archive, and keep the permissions and modification times stored in the zip.
+    With a PermissionPolicy, owners and modes follow it instead as files are
+    written (paths being relative to root, dest by default).
+    Returns (files, bytes) written.
+    """
+    workers = workers or min(8, os.cpu_count() or 1)
+    root = root or dest
+
+    with TRACER.phase("extract", workers=workers) as ph:
+
+        with zipfile.ZipFile(zip_path, "r") as zf:
+            infos = zf.infolist()
+
+        dirs = {}
+        files = []
+        for info in infos:
+            path = _zipMemberPath(dest, info.filename, strip)
+            if path is None:
+                continue
+            if info.is_dir():
+                dirs[path] = info
+            else:
+                files.append((info, path))
+                dirs.setdefault(os.path.dirname(path), None)
+
+        if policy is not None:
+            # Intermediate directories without a zip entry are created too
+            for d in list(dirs):
+                while d != dest and d.startswith(dest):
+                    d = os.path.dirname(d)
+                    dirs.setdefault(d, None)
+
+        os.makedirs(dest, exist_ok=True)
+        for d in sorted(dirs):
+            os.makedirs(d, exist_ok=True)
+
+        # Round-robin so large and small members are spread evenly across workers
+        batches = [files[i::workers] for i in range(workers)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            written = sum(pool.map(lambda b: _extractMembers(zip_path, b, chunk_size, policy, root), [b for b in batches if b]))
+
+        # Directories last (deepest first), writing their content changed their mtime
+        for d in sorted(dirs, key=len, reverse=True):
+            if policy is not None:
+                policy.fix(d, os.path.relpath(d, root), True)
+            info = dirs[d]
+            if info is None:
+                continue
+            mode = (info.external_attr >> 16) & 0o7777
+            if mode and policy is None:
+                os.chmod(d, mode)
+            mtime = _zipMemberTime(info)
+            os.utime(d, (mtime, mtime))
+
+        ph["items"] = len(files)
+        ph["bytes"] = written
+    return(len(files), written)
+
+
+FICLONE = 0x40049409
+
+# Paths a site owns and modifies, they are always deployed as private copies
+SITE_OWNED = ("wp-content", "wp-config.php", "wp-config-sample.php", ".htaccess")
+
+def _isSiteOwned(rel):
+    return(rel.split(os.sep, 1)[0] in SITE_OWNED)
+
+def _reflink(src, dst):
+    with open(src, "rb") as fs, open(dst, "wb") as fd:
+        fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+
+def _copyWritable(src, dst):
+    shutil.copy2(src, dst)
+    os.chmod(dst, os.stat(src).st_mode | 0o200)
+
+def deployTree(src, dest, mode="auto", excludes=()):
+    """
+    Populate dest from an extracted core tree (see ReleaseCache.tree) or a site.
+
+    Files are reflinked (FICLONE) when the filesystem supports it, otherwise core
+    files are hardlinked to the source; site-owned paths (SITE_OWNED) are never
+    hardlinked. mode is one of 'auto', 'reflink', 'hardlink' or 'copy'. Paths
+    relative to src matching one of the excludes (fnmatch patterns) are skipped.
+    Returns a dict counting files per method.
+    """
+    stats = {"reflink": 0, "hardlink": 0, "copy": 0, "symlink": 0}
+    can_reflink = mode in ("auto", "reflink")
+    can_link = mode in ("auto", "hardlink")
+
+    def walk(sdir, ddir, rel):
+        nonlocal can_reflink, can_link
+        os.makedirs(ddir, exist_ok=True)
+
+        with os.scandir(sdir) as it:
+            entries = list(it)
+
+        for e in entries:
+            erel = os.path.join(rel, e.name) if rel else e.name
+            target = os.path.join(ddir, e.name)
+
+            if excludes and any(fnmatch.fnmatch(erel, x) for x in excludes):
+                continue
+
+            if e.is_dir(follow_symlinks=False):
+                walk(e.path, target, erel)
+                continue
+
+            if os.path.lexists(target):
+                os.remove(target)
+
+            if e.is_symlink():
+                os.symlink(os.readlink(e.path), target)
+                stats["symlink"] += 1
+                continue
+
+            # A reflink is a private copy, only hardlinks must stay out of site-owned paths
+            if can_reflink:
+                try:
+                    _reflink(e.path, target)
+                    shutil.copystat(e.path, target)
+                    os.chmod(target, e.stat().st_mode | 0o200)
+                    stats["reflink"] += 1
+                    continue
+                except OSError:
+                    can_reflink = False
+                    if os.path.lexists(target):
+                        os.remove(target)
+            if can_link and not _isSiteOwned(erel):
+                try:
+                    os.link(e.path, target)
+                    stats["hardlink"] += 1
+                    continue
+                except OSError:
+                    can_link = False
+
+            _copyWritable(e.path, target)
+            stats["copy"] += 1
+
+        shutil.copystat(sdir, ddir)
+
+    with TRACER.phase("copy", mode=mode) as ph:
+        walk(src, dest, "")
+        ph["items"] = sum(stats.values())
+    return(stats)
+
+# Site paths the web server writes to
+WRITABLE_DIRS = ("wp-content/uploads",)
+
+class PermissionPolicy:
+    """
+    Ownership and modes of an install: files 644 and directories 755, wp-config.php
+    640, and group-writable WRITABLE_DIRS. The owner and group are kept when None
+    (changing them needs root). As PHP may then run as anybody, wp-config.php stays
+    644 without an owner or group, and can't be given a stricter mode.
+    """
+
+    def __init__(self, owner=None, group=None, file_mode=0o644, dir_mode=0o755, config_mode=None,
+                 writable=WRITABLE_DIRS, writable_file_mode=0o664, writable_dir_mode=0o775):
+        self.uid = pwd.getpwnam(owner).pw_uid if owner else None
+        if group:
+            self.gid = grp.getgrnam(group).gr_gid
+        else:
+            self.gid = pwd.getpwnam(owner).pw_gid if owner else None
+        if config_mode is None:
+            config_mode = 0o644 if self.uid is None and self.gid is None else 0o640
+        elif config_mode & 0o644 != 0o644 and self.uid is None and self.gid is None:
+            raise InstallError(f"A wp-config.php mode of {config_mode:o} needs an owner or group, or PHP may not read it")
+        self.file_mode = file_mode
+        self.dir_mode = dir_mode
+        self.config_mode = config_mode
+        self.writable = tuple(os.path.join(*w.split("/")) for w in writable)
+        self.writable_file_mode = writable_file_mode
+        self.writable_dir_mode = writable_dir_mode
+
+    @classmethod
+    def fromSpec(cls, spec=None, **modes):
+        """Policy for 'user[:group]' (None keeps the owner), modes being given as keyword arguments"""
+        owner, _, group = (spec or "").partition(":")
+        try:
+            return(cls(owner or None, group or None, **{k: v for k, v in modes.items() if v is not None}))
+        except KeyError as e:
+            raise InstallError(f"Unknown user or group in '{spec}': {e}")
+
+    def mode(self, rel, is_dir):
+        """Expected mode of the entry at rel (relative to the site root)"""
+        if rel == "wp-config.php":
+            return(self.config_mode)
+        if any(rel == w or rel.startswith(w + os.sep) for w in self.writable):
+            return(self.writable_dir_mode if is_dir else self.writable_file_mode)
+        return(self.dir_mode if is_dir else self.file_mode)
+
+    def fix(self, path, rel, is_dir, st=None):
+        """Set owner and mode of path when they differ from st, returning (chowned, chmoded)"""
+        st = st or os.lstat(path)
+        chowned = (self.uid is not None and st.st_uid != self.uid) or (self.gid is not None and st.st_gid != self.gid)
+        if chowned:
+            os.chown(path, -1 if self.uid is None else self.uid, -1 if self.gid is None else self.gid)
+        mode = self.mode(rel, is_dir)
+        chmoded = st.st_mode & 0o7777 != mode
+        if chmoded:
+            os.chmod(path, mode)
+        return(chowned, chmoded)
+
+    def fixFd(self, fd, rel, is_dir=False):
+        """Set owner and mode of a file just created, through its descriptor"""
+        if self.uid is not None or self.gid is not None:
+            os.fchown(fd, -1 if self.uid is None else self.uid, -1 if self.gid is None else self.gid)
+        os.fchmod(fd, self.mode(rel, is_dir))
+
+def _policyDeployMode(mode, policy):
+    """Deployment mode to use with a policy, hardlinks being replaced by reflinks or copies"""
+    if policy is None or mode not in ("auto", "hardlink"):
+        return(mode)
+    if mode == "hardlink":
+        log("Hardlinked files can't follow the permission policy, they are copied instead", "warning")
+    return("reflink")
+
+def _policyDir(root, rel, policy):
+    subdirs = []
+    stats = {"checked": 0, "chown": 0, "chmod": 0, "linked": 0}
+    with os.scandir(os.path.join(root, rel)) as it:
+        for e in it:
+            if e.is_symlink():
+                continue
+            erel = os.path.join(rel, e.name) if rel else e.name
+            st = e.stat(follow_symlinks=False)
+            is_dir = e.is_dir(follow_symlinks=False)
+            if is_dir:
+                subdirs.append(erel)
+            elif st.st_nlink > 1:
+                # Hardlinked from the shared core tree, changing it would change every site
+                stats["linked"] += 1
+                continue
+            stats["checked"] += 1
+            chowned, chmoded = policy.fix(e.path, erel, is_dir, st)
+            stats["chown"] += chowned
+            stats["chmod"] += chmoded
+    return(subdirs, stats)
+
+def applyPolicy(root, policy, workers=None, only=None):
+    """
+    Apply a PermissionPolicy to the site in root, creating its writable directories.
+
+    The tree is walked breadth first with os.scandir, each level's directories spread
+    over a thread pool, and only entries that differ from the policy are changed.
+    Hardlinked files (shared with the core tree of the cache) are never touched.
+    With only, just those paths (relative to root) are checked, for what was written
+    after an extraction that already applied the policy. Returns a dict of counts.
+    """
+    workers = workers or min(8, os.cpu_count() or 1)
+    stats = {"checked": 0, "chown": 0, "chmod": 0, "linked": 0}
+
+    with TRACER.phase("permissions", workers=workers) as ph:
+        for w in policy.writable:
+            os.makedirs(os.path.join(root, w), exist_ok=True)
+
+        for rel in ([""] if only is None else only):
+            path = os.path.join(root, rel) if rel else root
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            is_dir = os.path.isdir(path)
+            if not is_dir and st.st_nlink > 1:
+                stats["linked"] += 1
+                continue
+            stats["checked"] += 1
+            chowned, chmoded = policy.fix(path, rel, is_dir, st)
+            stats["chown"] += chowned
+            stats["chmod"] += chmoded
+
+        level = [""] if only is None else []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while level:
+                found = list(pool.map(lambda rel: _policyDir(root, rel, policy), level))
+                level = [d for subdirs, _ in found for d in subdirs]
+                for _, st in found:
+                    for k in stats:
+                        stats[k] += st[k]
+
+        ph["items"] = stats["checked"]
+    return(stats)
+
+
+
+
+
+# Paths a core sync never writes nor deletes
+SYNC_KEEP = ("wp-content", "wp-config.php", ".htaccess")
+# Directories wholly owned by the core, where files unknown upstream are deleted
+SYNC_CORE_DIRS = ("wp-admin", "wp-includes")
+
+def _treeFiles(root, keep=()):
+    """{relative path: os.DirEntry} of every file below root, skipping the keep top-level entries"""
+    files = {}
+
+    def walk(d, rel):
+        with os.scandir(d) as it:
+            for e in it:
+                erel = os.path.join(rel, e.name) if rel else e.name
+                if not rel and e.name in keep:
+                    continue
+                if e.is_dir(follow_symlinks=False):
+                    walk(e.path, erel)
+                else:
+                    files[erel] = e
+
+    walk(root, "")
+    return(files)
+
+def _syncWrite(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.wp_install.tmp"
+    _copyWritable(src, tmp)
+    # The site keeps serving the old file until the new one is complete
+    os.replace(tmp, dst)
+
+def syncCore(src, dest, old_files=None, workers=None):
+    """
+    Bring the core files of the site in dest to the release tree src, in place.
+
+    A file is rewritten only when its size differs, or when its mtime differs and
+    its sha1 too (a file with the same content only gets its mtime fixed, unless it
+    is hardlinked, then it is rewritten so the other links keep their mtime). Files
+    unknown upstream are deleted from wp-admin and wp-includes, and elsewhere only
+    when old_files (the file list of the release installed until now) has them.
+    wp-content, wp-config.php and .htaccess are never touched.
+    Returns a dict of counters.
+    """
+    stats = {"unchanged": 0, "updated": 0, "added": 0, "deleted": 0, "bytes": 0}
+
+    with TRACER.phase("sync") as ph:
+        wanted = _treeFiles(src, SYNC_KEEP)
+        present = _treeFiles(dest, SYNC_KEEP) if os.path.isdir(dest) else {}
+
+        changed = []
+        ambiguous = []
+        for rel, e in wanted.items():
+            d = present.get(rel)
+            if d is None:
+                changed.append((rel, "added"))
+                continue
+            st, dt = e.stat(), d.stat(follow_symlinks=False)
+            if d.is_symlink() or st.st_size != dt.st_size:
+                changed.append((rel, "updated"))
+            elif int(st.st_mtime) != int(dt.st_mtime):
+                ambiguous.append(rel)
+            else:
+                stats["unchanged"] += 1
+
+        def sameContent(rel):
+            return(fileHash(wanted[rel].path) == fileHash(present[rel].path))
+
+        with ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 1) + 2)) as pool:
+            for rel, same in zip(ambiguous, pool.map(sameContent, ambiguous)):
+                # A hardlinked file is shared with the cache tree of the old release
+                # and every site deployed from it, it gets its own copy instead
+                if same and present[rel].stat(follow_symlinks=False).st_nlink == 1:
+                    shutil.copystat(wanted[rel].path, present[rel].path)
+                    stats["unchanged"] += 1
+                else:
+                    changed.append((rel, "updated"))
+
+            def write(item):
+                rel, what = item
+                _syncWrite(wanted[rel].path, os.path.join(dest, rel))
+                return(what, wanted[rel].stat().st_size)
+
+            for what, size in pool.map(write, changed):
+                stats[what] += 1
+                stats["bytes"] += size
+
+        for rel in present:
+            if rel in wanted:
+                continue
+            if rel.split(os.sep, 1)[0] in SYNC_CORE_DIRS or (old_files is not None and rel in old_files):
+                os.remove(os.path.join(dest, rel))
+                stats["deleted"] += 1
+
+        # Directories emptied by the deletions
+        for top in SYNC_CORE_DIRS:
+            for d, subdirs, files in os.walk(os.path.join(dest, top), topdown=False):
+                if not subdirs and not files and not os.path.isdir(os.path.join(src, os.path.relpath(d, dest))):
+                    os.rmdir(d)
+
+        ph["items"] = stats["updated"] + stats["added"] + stats["deleted"]
+        ph["bytes"] = stats["bytes"]
+
+    return(stats)
+
+def writeWpConfig(wp_directory, db_config, wp_config=None, backup=True, keys=None):
+    """
+    Args:
+        wp_directory (str): Répertoire WordPress
+        db_config (dict): Configuration base de données
+            {
+                'db_name': 'nom_db',
+                'db_user': 'utilisateur',
+                'db_password': 'mot_de_passe',
+                'db_host': 'localhost',
+                'db_charset': 'utf8mb4',
+                'db_collate': ''
+            }
+        wp_config (dict, optional): Configuration WordPress additionnelle
+            {
+                'table_prefix': 'wp_',
+                'debug': False,
+                'debug_log': False,
+                'wp_memory_limit': '256M',
+                'custom_constants': {'WP_CACHE': True}
+            }
+        backup (bool): Créer un backup avant modification
+        keys (dict, optional): Clés de sécurité déjà obtenues (voir fetchSecurityKeys)
+    """
+    
+    if wp_config is None:
+        wp_config = {}
+    
+    config_file = os.path.join(wp_directory, 'wp-config.php')
+    sample_file = os.path.join(wp_directory, 'wp-config-sample.php')
+    
+    result = {
+        'success': False,
+        'action': '',
+        'message': '',
+        'backup_file': None
+    }
+    
+    try:
+        if os.path.exists(config_file):
+            result = _modify_existing_config(config_file, db_config, wp_config, backup, keys)
+
+        elif os.path.exists(sample_file):
+            shutil.copyfile(sample_file, config_file)
+
+            result = _modify_existing_config(config_file, db_config, wp_config, False, keys)
+            
+        else:
+            r = httpClient().get(WP_CONFIG_SAMPLE_URL, timeout=10)
+            if r.status_code != 200:
+                print(f"      Failed to download the sample config file.\nUsing the static config")
+                
+                with open(config_file, "w") as f:
+                    f.write(WP_CONFIG_SAMPLE)
+            else:
+                with open(sample_file, "wb") as f:
+                    f.write(r.content)
+                
+                shutil.copyfile(sample_file, config_file)
+            
+            result = _modify_existing_config(config_file, db_config, wp_config, False, keys)
+        
+        if result['success']:
+            validation = result.pop('validation')
+            if not validation['valid']:
+                result['success'] = False
+                result['message'] += f" Validation échouée: {validation['error']}"
+        
+        return result
+        
+    except Exception as e:
+        return {
+            'success': False,
+            'action': 'error',
+            'message': f'Erreur lors de la configuration: {str(e)}',
+            'backup_file': None
+        }
+
+def atomicWrite(path, content, encoding='utf-8'):
+    """Replace path with content through a fsynced temporary file, keeping its mode and owner"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding=encoding) as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.exists(path):
+            st = os.stat(path)
+            os.chmod(tmp, st.st_mode & 0o7777)
+            if os.geteuid() == 0:
+                os.chown(tmp, st.st_uid, st.st_gid)
+        else:
+            os.chmod(tmp, 0o644)
+
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    dfd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dfd)
+    finally:
+        os.close(dfd)
+
+def _backupConfig(config_file, root=CACHE_DIR):
+    """
+    Copy of a wp-config.php under <root>/backups/<site>-<hash>, outside of the web
+    root where it could be served as text, readable by its owner only.
+    """
+    site = os.path.dirname(os.path.abspath(config_file))
+    bdir = os.path.join(root, "backups")
+    os.makedirs(bdir, mode=0o700, exist_ok=True)
+    bdir = os.path.join(bdir, f"{os.path.basename(site)}-{hashlib.sha1(site.encode()).hexdigest()[:12]}")
+    os.makedirs(bdir, mode=0o700, exist_ok=True)
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    backup_file = os.path.join(bdir, f"wp-config.php.backup_{timestamp}")
+    fd = os.open(backup_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as out, open(config_file, "rb") as f:
+        shutil.copyfileobj(f, out)
+    return(backup_file)
+
+def _modify_existing_config(config_file, db_config, wp_config, backup, keys=None):
+    """Modifier un fichier wp-config.php existant"""
+    
+    result = {
+        'success': True,
+        'action': 'modified',
+        'message': 'Configuration existante modifiée',
+        'backup_file': None,
+        'validation': None
+    }
+    
+    if backup:
+        result['backup_file'] = _backupConfig(config_file)
+    
+    with TRACER.phase("config") as ph:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            cfg = WpConfig(f.read())
+    
+        _update_db_constants(cfg, db_config)
+        _update_wp_constants(cfg, wp_config)
+        _replace_security_keys(cfg, keys)
+        content = cfg.render()
+
+        result['validation'] = cfg.validate()
+        if not result['validation']['valid']:
+            result['success'] = False
+            result['message'] = f"Configuration non écrite: {result['validation']['error']}"
+            return result
+    
+        atomicWrite(config_file, content)
+        ph["bytes"] = len(content)
+    
+    return result
+
+def _phpValue(value):
+    if isinstance(value, bool):
+        return("true" if value else "false")
+    if value is None:
+        return("null")
+    if isinstance(value, (int, float)):
+        return(str(value))
+    value = str(value).replace("\\", "\\\\").replace("'", "\\'")
+    return(f"'{value}'")
+
+_PHP_STRING = {
+    "'": re.compile(r"'(?:[^'\\]|\\.)*'", re.S),
+    '"': re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+}
+_PHP_TOKEN = re.compile(r"""['"#$]|/[/*]|[A-Za-z_][A-Za-z0-9_]*""")
+_PHP_OPEN_TAG = re.compile(r"<\?php\b")
+_ABSPATH_IF = re.compile(r"if\s*\(\s*!\s*defined\s*\(\s*['\"]ABSPATH['\"]\s*\)\s*\)\s*\{", re.I)
+_DOUBLE_QUOTE_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "v": "\v", "e": "\x1b", "f": "\f", "\\": "\\", "$": "$", '"': '"'}
+
+def _phpLiteral(expr):
+    """Python value of a scalar PHP literal, None if expr is anything else"""
+    expr = expr.strip()
+    if len(expr) >= 2 and expr[0] == expr[-1] == "'":
+        return(re.sub(r"\\([\\'])", r"\1", expr[1:-1]))
+    if len(expr) >= 2 and expr[0] == expr[-1] == '"':
+        return(re.sub(r'\\(.)', lambda m: _DOUBLE_QUOTE_ESCAPES.get(m.group(1), m.group(0)), expr[1:-1]))
+    low = expr.lower()
+    if low in ("true", "false"):
+        return(low == "true")
+    if low == "null":
+        return(None)
+    if re.fullmatch(r"-?\d+", expr):
+        return(int(expr))
+    if re.fullmatch(r"-?\d*\.\d+", expr):
+        return(float(expr))
+    return(None)
+
+class WpConfig:
+    """
+    wp-config.php indexed in a single pass.
+
+    The scan skips strings and comments and records every define() call, the
+    $table_prefix assignment and the anchors used to insert missing entries (the
+    database and salts sections, the "stop editing" comment, the ABSPATH block).
+    set() and setTablePrefix() only record the values (the last one wins), render()
+    applies all of them at once, and validate() checks the rendered result.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.defines = {}
+        self.duplicates = set()
+        self.table_prefix = None
+        self.anchors = {}
+        self._sets = {}
+        self._prefix = None
+        self._scan()
+
+    def _lineEnd(self, pos):
+        end = self.content.find("\n", pos)
+        return(len(self.content) if end == -1 else end)
+
+    def _skipString(self, i):
+        m = _PHP_STRING[self.content[i]].match(self.content, i)
+        return(m.end() if m else len(self.content))
+
+    def _comment(self, start, end):
+        text = self.content[start:end]
+        if "Database settings" in text or "Réglages MySQL" in text or "Réglages de la base de données" in text:
+            self.anchors.setdefault("db", self._lineEnd(start))
+        elif "Authentication unique keys and salts" in text or "Clés uniques d" in text:
+            self.anchors.setdefault("keys", self._lineEnd(end - 1))
+        elif "That's all, stop editing" in text or "ne touchez pas à ce qui suit" in text:
+            self.anchors.setdefault("stop", start)
+
+    def _parseArgs(self, i):
+        """Spans of the comma separated arguments of the call whose '(' is at or after i"""
+        c, n = self.content, len(self.content)
+        while i < n and c[i].isspace():
+            i += 1
+        if i >= n or c[i] != "(":
+            return(None, i)
+
+        args = []
+        depth = 0
+        start = i + 1
+        i += 1
+        while i < n:
+            ch = c[i]
+            if ch in "'\"":
+                i = self._skipString(i)
+                continue
+            if ch in "([{":
+                depth += 1
+            elif ch in ")]}":
+                if depth == 0:
+                    args.append((start, i))
+                    return(args, i + 1)
+                depth -= 1
+            elif ch == "," and depth == 0:
+                args.append((start, i))
+                start = i + 1
+            i += 1
+        return(None, n)
+
+    def _statementEnd(self, i):
+        c, n = self.content, len(self.content)
+        j = i
+        while j < n and c[j] in " \t":
+            j += 1
+        return(j + 1 if j < n and c[j] == ";" else i)
+
+    def _strip(self, start, end):
+        c = self.content
+        while start < end and c[start].isspace():
+            start += 1
+        while end > start and c[end - 1].isspace():
+            end -= 1
+        return(start, end)
+
+    def _scan(self):
+        c, n = self.content, len(self.content)
+
+        m = _PHP_OPEN_TAG.search(c)
+        if m:
+            self.anchors["php"] = self._lineEnd(m.end())
+
+        i = 0
+        while True:
+            m = _PHP_TOKEN.search(c, i)
+            if m is None:
+                break
+            tok, i = m.group(0), m.start()
+
+            if tok in ("'", '"'):
+                i = self._skipString(i)
+            elif tok == "#" or tok == "//":
+                end = self._lineEnd(i)
+                self._comment(i, end)
+                i = end
+            elif tok == "/*":
+                end = c.find("*/", i + 2)
+                end = n if end == -1 else end + 2
+                self._comment(i, end)
+                i = end
+            elif tok == "$":
+                if c.startswith("$table_prefix", i) and self.table_prefix is None:
+                    j = i + len("$table_prefix")
+                    while j < n and c[j].isspace():
+                        j += 1
+                    if j < n and c[j] == "=" and c[j+1:j+2] != "=":
+                        vs = j + 1
+                        ve = vs
+                        while ve < n and c[ve] != ";":
+                            ve = self._skipString(ve) if c[ve] in "'\"" else ve + 1
+                        self.table_prefix = {"start": i, "end": min(ve + 1, n), "value": self._strip(vs, ve)}
+                        i = ve
+                        continue
+                i += 1
+            elif tok.lower() == "define" and c[i-1:i] not in (">", ":", "$"):
+                args, end = self._parseArgs(m.end())
+                if args and len(args) >= 2:
+                    name = _phpLiteral(c[slice(*self._strip(*args[0]))])
+                    if isinstance(name, str) and name in self.defines:
+                        self.duplicates.add(name)
+                    elif isinstance(name, str):
+                        self.defines[name] = {"start": i, "end": self._statementEnd(end), "value": self._strip(*args[1])}
+                i = end if args else m.end()
+            elif tok.lower() == "if" and "abspath" not in self.anchors and _ABSPATH_IF.match(c, i):
+                self.anchors["abspath"] = i
+                i = m.end()
+            else:
+                i = m.end()
+
+    def has(self, name):
+        return(name in self.defines or name in self._sets)
+
+    def raw(self, name):
+        d = self.defines.get(name)
+        return(None if d is None else self.content[slice(*d["value"])])
+
+    def get(self, name, default=None):
+        d = self.defines.get(name)
+        if d is None:
+            return(default)
+        return(_phpLiteral(self.content[slice(*d["value"])]))
+
+    def getTablePrefix(self):
+        if self.table_prefix is None:
+            return(None)
+        return(_phpLiteral(self.content[slice(*self.table_prefix["value"])]))
+
+    def _insertPos(self, kind):
+        order = {
+            "db": ["db", "php"],
+            "keys": ["keys", "stop", "abspath"],
+            "wp": ["stop", "abspath"]
+        }[kind]
+        for a in order:
+            if a in self.anchors:
+                return(a, self.anchors[a])
+        return(None, len(self.content))
+
+    def set(self, name, value, kind="wp"):
+        """Record define(name, value); kind picks where a missing define goes: 'db', 'keys' or 'wp'"""
+        # Setting a name again replaces its value (and keeps where it was first placed)
+        kind = self._sets[name][0] if name in self._sets else kind
+        self._sets[name] = (kind, value)
+
+    def setTablePrefix(self, prefix):
+        self._prefix = prefix
+
+    def render(self):
+        """Content with every recorded value applied, in one pass over the original text"""
+        edits = []
+        inserts = {}
+
+        def insert(kind, text):
+            anchor, pos = self._insertPos(kind)
+            # Lines inserted at the same place are rendered as one block
+            inserts.setdefault(pos, (anchor, []))[1].append(text)
+
+        key_end = None
+        if any(k in self.defines for k in SECURITY_KEY_NAMES):
+            key_end = self._lineEnd(max(self.defines[k]["end"] for k in SECURITY_KEY_NAMES if k in self.defines))
+
+        for name, (kind, value) in self._sets.items():
+            d = self.defines.get(name)
+            if d is not None:
+                edits.append((d["value"][0], d["value"][1], _phpValue(value)))
+            elif kind == "keys" and key_end is not None:
+                # Right after the last existing key
+                edits.append((key_end, key_end, f"\ndefine( '{name}', {_phpValue(value)} );"))
+            else:
+                insert(kind, f"define( '{name}', {_phpValue(value)} );")
+
+        if self._prefix is not None:
+            if self.table_prefix is not None:
+                edits.append((self.table_prefix["value"][0], self.table_prefix["value"][1], _phpValue(self._prefix)))
+            else:
+                insert("wp", f"$table_prefix = {_phpValue(self._prefix)};")
+
+        for pos, (anchor, lines) in inserts.items():
+            block = "\n".join(lines)
+            if anchor in ("db", "keys", "php"):
+                # After the anchor line
+                edits.append((pos, pos, f"\n{block}"))
+            elif anchor is None:
+                edits.append((pos, pos, f"{'' if self.content.endswith(chr(10)) else chr(10)}{block}\n"))
+            else:
+                edits.append((pos, pos, f"{block}\n\n"))
+
+        out = []
+        last = 0
+        # Sorted is stable: texts inserted at the same position keep their order
+        for start, end, text in sorted(edits, key=lambda e: (e[0], e[1])):
+            if start < last:
+                continue
+            out.append(self.content[last:start])
+            out.append(text)
+            last = end
+        out.append(self.content[last:])
+        return("".join(out))
+
+    def validate(self):
+        """Check the rendered content (the original one when nothing is set)"""
+        cfg = WpConfig(self.render()) if self._sets or self._prefix is not None else self
+
+        missing = [c for c in ['DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_HOST'] if c not in cfg.defines]
+        if missing:
+            return {
+                'valid': False,
+                'error': f"Constantes manquantes: {', '.join(missing)}"
+            }
+
+        # Duplicates already in the file are left to their owner
+        added = cfg.duplicates - self.duplicates
+        if added:
+            return {
+                'valid': False,
+                'error': f"Constantes définies plusieurs fois: {', '.join(sorted(added))}"
+            }
+
+        if not cfg.content.lstrip().startswith('<?php'):
+            return {
+                'valid': False,
+                'error': "Le fichier ne commence pas par <?php"
+            }
+
+        return {'valid': True, 'error': None}
+
+def _update_db_constants(cfg, db_config):
+    for vr in ['DB_NAME','DB_USER','DB_PASSWORD','DB_HOST','DB_CHARSET','DB_COLLATE']:
+        if vr in db_config.keys():
+            cfg.set(vr, str(db_config[vr]), "db")
+
+def _update_wp_constants(cfg, wp_config):
+    if "table_prefix" in wp_config.keys():
+        cfg.setTablePrefix(wp_config['table_prefix'])
+    
+    wp_constants = {}
+    for vr in ["WP_DEBUG","WP_DEBUG_LOG","WP_MEMORY_LIMIT"]:
+        if vr in wp_config.keys():
+            wp_constants[vr] = wp_config[vr]
+    wp_constants.update(wp_config.get("custom_constants", {}))
+    
+    for constant, value in wp_constants.items():
+        cfg.set(constant, value, "wp")
+
+SECURITY_KEY_NAMES = [
+    'AUTH_KEY', 'SECURE_AUTH_KEY', 'LOGGED_IN_KEY', 'NONCE_KEY',
+    'AUTH_SALT', 'SECURE_AUTH_SALT', 'LOGGED_IN_SALT', 'NONCE_SALT'
+]
+
+SALT_ALPHABET = string.ascii_letters + string.digits + "!@#$%^&*()-_=+[]{}|;:,.<>?"
+SALT_LENGTH = 64
+
+# Random bytes past the last multiple of the alphabet size are rejected so that
+# every character stays equally likely
+_SALT_LIMIT = 256 - 256 % len(SALT_ALPHABET)
+_SALT_TABLE = bytes(ord(SALT_ALPHABET[b % len(SALT_ALPHABET)]) if b < _SALT_LIMIT else 0 for b in range(256))
+_SALT_REJECT = bytes(range(_SALT_LIMIT, 256))
+
+def generateSalts(count=1, key_names=SECURITY_KEY_NAMES, length=SALT_LENGTH):
+    """
+    Generate the security keys of count sites locally.
+
+    All the randomness comes from bulk secrets.token_bytes() reads mapped onto
+    SALT_ALPHABET (no quote nor backslash, safe in a PHP string) with rejection
+    sampling, instead of one secrets.choice() call per character.
+
+    Returns:
+        list: count dicts {key_name: key_value}
+    """
+    needed = count * len(key_names) * length
+    chars = b""
+    while len(chars) < needed:
+        missing = needed - len(chars)
+        raw = secrets.token_bytes(missing * 256 // _SALT_LIMIT + 64)
+        chars += raw.translate(_SALT_TABLE, _SALT_REJECT)
+    chars = chars[:needed].decode("ascii")
+
+    salts = []
+    pos = 0
+    for _ in range(count):
+        keys = {}
+        for key_name in key_names:
+            keys[key_name] = chars[pos:pos + length]
+            pos += length
+        salts.append(keys)
+    return(salts)
+
+_SALT_DEFINE = re.compile(r"define\(\s*'(\w+)'\s*,\s*'((?:[^'\\]|\\.)*)'\s*\);")
+
+def parseSecurityKeys(text):
+    """
+    Security keys of the define() lines returned by the wordpress.org API.
+    Raises ValueError unless all of SECURITY_KEY_NAMES are there.
+    """
+    keys = {kn: re.sub(r"\\(.)", r"\1", kv) for kn, kv in _SALT_DEFINE.findall(text)}
+    missing = [kn for kn in SECURITY_KEY_NAMES if not keys.get(kn)]
+    if missing:
+        raise ValueError(f"Missing security keys: {', '.join(missing)}")
+    return({kn: keys[kn] for kn in SECURITY_KEY_NAMES})
+
+def fetchSecurityKeys(session=None, remote=False):
+    """Security keys generated locally, or from the wordpress.org API with remote (local if it is unavailable)"""
+    if not remote:
+        return(generateSalts(1)[0])
+
+    http = session or httpClient()
+    try:
+        with TRACER.phase("salts"):
+            response = http.get(WP_SALT_URL, timeout=10)
+        response.raise_for_status()
+        return(parseSecurityKeys(response.text))
+    except (requests.RequestException, ValueError) as e:
+        log(f"Security keys generated locally, the wordpress.org API failed: {e}", "warning")
+        return(_generate_security_keys(SECURITY_KEY_NAMES))
+
+def _replace_security_keys(cfg, new_keys=None):
+    if new_keys is None:
+        new_keys = fetchSecurityKeys()
+
+    for key_name in SECURITY_KEY_NAMES:
+        cfg.set(key_name, new_keys[key_name], "keys")
+
+def _generate_security_keys(key_names):
+    return(generateSalts(1, key_names)[0])
+
+WP_MARKERS = ["wp-admin","wp-content","wp-includes","wp-login.php","wp-load.php","wp-config.php","wp-settings.php"]
+
+def wpMarkerCount(entries):
+    return(len([1 for f in WP_MARKERS if f in entries]))
+
+def _versionPhpVar(root, var):
+    try:
+        with open(os.path.join(root, "wp-includes", "version.php"), "r", encoding="utf-8") as f:
+            m = re.search(r"\$" + var + r"\s*=\s*['\"]([^'\"]+)['\"]", f.read())
+    except OSError:
+        return(None)
+    return(m.group(1) if m else None)
+
+def readWpVersion(root):
+    """$wp_version of the WordPress core in root, None if it can't be read"""
+    return(_versionPhpVar(root, "wp_version"))
+
+def readWpLocale(root):
+    """Locale of a localized WordPress package ($wp_local_package), None for en_US"""
+    return(_versionPhpVar(root, "wp_local_package"))
+
+# Directories never searched for installs
+SCAN_SKIP = set(WP_MARKERS) | {"node_modules", "cgi-bin"}
+
+def _isBelow(path, roots):
+    return(any(path == r or path.startswith(r.rstrip(os.sep) + os.sep) for r in roots))
+
+class Inventory:
+    """
+    Index of the WordPress installs found below a set of vhost roots.
+
+    Every directory is recorded with its mtime: on the next scan, a directory whose
+    mtime didn't change reuses its recorded listing instead of being read again, and
+    a site's version and database are only read again once wp-config.php or
+    wp-includes/version.php changed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(CACHE_DIR, "inventory.json")
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        self.dirs = data.get("dirs", {})
+        self.sites = data.get("sites", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"dirs": self.dirs, "sites": self.sites}, f)
+        os.replace(tmp, self.path)
+
+    def _scanDir(self, d):
+        st = os.stat(d)
+        old = self.dirs.get(d)
+        if old is not None and old["mtime"] == st.st_mtime_ns:
+            return(old)
+
+        with os.scandir(d) as it:
+            entries = list(it)
+        return({
+            "mtime": st.st_mtime_ns,
+            "site": wpMarkerCount([e.name for e in entries]) > 2,
+            "subdirs": sorted(e.path for e in entries if e.is_dir(follow_symlinks=False) and e.name not in SCAN_SKIP and not e.name.startswith("."))
+        })
+
+    def _siteInfo(self, root):
+        stamp = []
+        for f in ("wp-config.php", os.path.join("wp-includes", "version.php")):
+            try:
+                stamp.append(os.stat(os.path.join(root, f)).st_mtime_ns)
+            except OSError:
+                stamp.append(None)
+
+        old = self.sites.get(root)
+        if old is not None and old["stamp"] == stamp:
+            return(old)
+
+        info = {"stamp": stamp, "version": readWpVersion(root), "locale": readWpLocale(root) or "en_US",
+                "db_name": None, "db_user": None, "db_host": None, "table_prefix": None}
+        try:
+            with open(os.path.join(root, "wp-config.php"), "r", encoding="utf-8") as f:
+                cfg = WpConfig(f.read())
+            info.update(db_name=cfg.get("DB_NAME"), db_user=cfg.get("DB_USER"), db_host=cfg.get("DB_HOST"), table_prefix=cfg.getTablePrefix())
+        except (OSError, UnicodeDecodeError):
+            pass
+        return(info)
+
+    def scan(self, roots, max_depth=4, jobs=8):
+        """Refresh the index below roots (at most max_depth levels deep) and save it"""
+        roots = [os.path.abspath(r) for r in roots]
+        dirs = {}
+        sites = {}
+
+        def visit(item):
+            d, depth = item
+            try:
+                rec = self._scanDir(d)
+            except OSError:
+                return(d, depth, None, None)
+            return(d, depth, rec, self._siteInfo(d) if rec["site"] else None)
+
+        with TRACER.phase("scan") as ph, ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            frontier = [(r, 0) for r in roots]
+            while frontier:
+                nxt = []
+                for d, depth, rec, info in pool.map(visit, frontier):
+                    if rec is None or d in dirs:
+                        continue
+                    dirs[d] = rec
+                    if info is not None:
+                        sites[d] = info
+                    if depth < max_depth:
+                        nxt.extend((sd, depth + 1) for sd in rec["subdirs"])
+                frontier = nxt
+            ph["items"] = len(dirs)
+
+        # Entries of roots that weren't part of this scan are kept
+        self.dirs = {k: v for k, v in self.dirs.items() if not _isBelow(k, roots)}
+        self.dirs.update(dirs)
+        self.sites = {k: v for k, v in self.sites.items() if not _isBelow(k, roots)}
+        self.sites.update(sites)
+        self.save()
+        return(sorted(sites))
+
+    def find(self, db_name=None):
+        """Indexed site roots, those using db_name only when it is given"""
+        return(sorted(r for r, info in self.sites.items() if db_name is None or info["db_name"] == db_name))
+
+def printInventory(inventory, roots):
+    cols = ["path", "version", "locale", "db_name", "table_prefix"]
+    rows = [[r] + [str(inventory.sites[r][c] or "-") for c in cols[1:]] for r in roots]
+    widths = [max([len(c)] + [len(row[i]) for row in rows]) for i,c in enumerate(cols)]
+
+    print("  ".join(c.upper().ljust(w) for c,w in zip(cols, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v,w in zip(row, widths)))
+
+def loadManifest(path):
+    """
+    Read a batch manifest, either a list of sites or {"defaults": {...}, "sites": [...]}.
+
+    Site keys: name, path (required), db_host, locale, version, table_prefix, constants
+    (dict of extra define()s), plugins and themes ('slug', 'slug@version' or
+    {"slug", "version"}), overwrite, and nodb with db_name/db_user/db_password. A
+    db_host other than the local server needs nodb.
+    With template, the database is cloned from the template of the version and table
+    prefix (see makeTemplate) and patched with url, title, admin_user, admin_email
+    and admin_password (generated when missing).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"sites": data}
+
+    defaults = data.get("defaults", {})
+    sites = []
+    errors = []
+    db_names = {}
+    for i, site in enumerate(data.get("sites", [])):
+        st = dict(defaults)
+        st.update(site)
+        sites.append(st)
+        if not st.get("name") or not st.get("path"):
+            errors.append(f"Site #{i} needs a 'name' and a 'path'")
+            continue
+        try:
+            sitePackages(st)
+            if not st.get("nodb"):
+                # The database and its user are created on the local admin connection
+                if not _isLocalDbHost(st.get("db_host", "localhost")):
+                    raise InstallError(f"db_host '{st['db_host']}' isn't the local server, use nodb with its db_name, db_user and db_password")
+                dbn = siteDbName(st["name"])
+                if dbn in db_names:
+                    raise InstallError(f"its database '{dbn}' is also the one of site #{db_names[dbn]}")
+                db_names[dbn] = i
+        except InstallError as e:
+            errors.append(f"Site #{i} ({st['name']}): {e}")
+
+    if errors:
+        raise InstallError(f"{len(errors)} invalid sites in {path}:\n  " + "\n  ".join(errors))
+    return(sites)
+
+def background(fn, *args, **kwargs):
+    """
+    Start fn on a daemon thread and return its Future.
+
+    Used for the install phases that only wait on the network or the database, so
+    they overlap; an interrupted run doesn't wait for them to finish.
+    """
+    fut = Future()
+
+    def run():
+        if not fut.set_running_or_notify_cancel():
+            return
+        try:
+            fut.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            fut.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return(fut)
+
+def sitePackages(site):
+    """packageSpec() of every plugin and theme a site or manifest entry asks for"""
+    return([packageSpec(kind, spec) for kind in PACKAGE_KINDS for spec in site.get(f"{kind}s", [])])
+
+def fetchPackages(packages, specs, jobs=8):
+    """Fetch packages concurrently, returning {spec: (path, version)}"""
+    specs = list(dict.fromkeys(specs))
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(specs) or 1))) as pool:
+        found = pool.map(lambda sp: packages.fetch(*sp), specs)
+        return(dict(zip(specs, found)))
+
+def installPackages(path, specs, packages, workers=None, policy=None):
+    """Extract plugins and themes into the wp-content of the site in path, returning 'slug version' strings"""
+    installed = []
+    for (kind, slug, _), (archive, version) in fetchPackages(packages, specs).items():
+        dest = os.path.join(path, "wp-content", f"{kind}s")
+        if os.path.exists(os.path.join(dest, slug)):
+            shutil.rmtree(os.path.join(dest, slug))
+        extractArchive(archive, dest, strip="", workers=workers, policy=policy, root=path)
+        installed.append(f"{slug} {version}")
+    return(installed)
+
+def prepareRelease(cache, locale=None, segments=1, deploy="extract", workers=None, version=None):
+    """
+    Fetch (and for linked deployments, extract) the release shared by every site of a
+    locale. When wordpress.org has no localized build of the locale, the default one
+    is used along with the core language pack of the locale.
+    """
+    wpv = getWpVersion(locale, version, cache.versions)
+    if wpv is None:
+        raise InstallError("Failed to fetch WordPress version information")
+
+    language = None
+    try:
+        archive, downloaded = cache.fetch(wpv, segments=segments)
+    except requests.HTTPError as e:
+        if not locale or wpv["locale"] != locale:
+            raise
+        log(f"No {locale} build of WordPress {wpv['version']} ({e}), falling back to the language pack", "warning")
+        wpv = getWpVersion(None, wpv["version"], cache.versions)
+        if wpv is None:
+            raise InstallError("Failed to fetch WordPress version information")
+        archive, downloaded = cache.fetch(wpv, segments=segments)
+
+    # Held for as long as the release is referenced, so that no eviction removes
+    # the archive or its tree while sites deploy from it
+    hold = cache.hold(archive)
+    if hold is None:
+        archive, downloaded = cache.fetch(wpv, segments=segments)
+        hold = cache.hold(archive)
+        if hold is None:
+            raise InstallError(f"WordPress {wpv['version']} was evicted from the cache as soon as it was fetched")
+
+    if locale and wpv["locale"] != locale:
+        language = {"locale": locale, "archive": PackageCache(cache.root).languagePack(wpv["version"], locale)}
+
+    tree = cache.tree(archive, workers=workers, language=language) if deploy != "extract" else None
+    return({"wpv": wpv, "archive": archive, "tree": tree, "language": language, "downloaded": downloaded, "hold": hold})
+
+def deployRelease(release, path, deploy="extract", workers=None, policy=None):
+    """
+    Write the core files of a prepared release into path, returning a short summary.
+    A PermissionPolicy is applied as the archive is extracted, or by a pass over the
+    deployed tree. Hardlinked files can't follow a policy without changing the
+    shared tree, so with one the files are reflinked or copied instead.
+    """
+    if release["tree"] is not None:
+        stats = deployTree(release["tree"], path, _policyDeployMode(deploy, policy))
+        msg = f"Deployed {stats['reflink']} reflinked, {stats['hardlink']} hardlinked and {stats['copy']} copied files"
+        if policy is not None:
+            st = applyPolicy(path, policy, workers)
+            msg += f", {st['chown']} chowned and {st['chmod']} chmoded"
+            if st["linked"]:
+                msg += f", {st['linked']} hardlinked files left alone"
+        return(msg)
+
+    nbf, nbb = extractArchive(release["archive"], path, workers=workers, policy=policy)
+    if release.get("language"):
+        nbf += extractArchive(release["language"]["archive"], os.path.join(path, "wp-content", "languages"), strip="", workers=workers, policy=policy, root=path)[0]
+    return(f"Extracted {nbf} files ({nbb // 1024} KiB)")
+
+class InstallJournal:
+    """
+    Checkpoints of one site's install, so that a rerun continues where the previous
+    run stopped.
+
+    Each phase is recorded as started, then done with its outputs. Secrets (the
+    database password) stay in the journal until the install is finished, in a file
+    only its owner can read, stored under <root>/journal rather than in the site.
+    The file is keyed on the site path and key (the site and database names, see
+    forSite), so that another site pointed at the same path doesn't resume it.
+    Without a site path the journal only lives in memory.
+    """
+
+    def __init__(self, site_path=None, root=CACHE_DIR, key=None):
+        self.path = None
+        self.data = {"site": site_path, "ident": None, "finished": False, "phases": {}}
+        self._lock = threading.Lock()
+
+        if site_path is not None:
+            jdir = os.path.join(root, "journal")
+            os.makedirs(jdir, mode=0o700, exist_ok=True)
+            name = site_path if key is None else f"{site_path}\n{key}"
+            self.path = os.path.join(jdir, f"{hashlib.sha1(name.encode()).hexdigest()}.json")
+            try:
+                with open(self.path, "r") as f:
+                    self.data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def _save(self):
+        # Caller must hold the journal lock
+        if self.path is None:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+    def has(self, phase):
+        return(phase in self.data["phases"])
+
+    def done(self, phase):
+        return(self.data["phases"].get(phase, {}).get("status") == "done")
+
+    def get(self, phase, key, default=None):
+        return(self.data["phases"].get(phase, {}).get(key, default))
+
+    def begin(self, phase, **outputs):
+        with self._lock:
+            self.data["phases"][phase] = dict(outputs, status="started")
+            self._save()
+
+    def complete(self, phase, **outputs):
+        with self._lock:
+            self.data["phases"][phase] = dict(outputs, status="done")
+            self._save()
+
+    def finished(self):
+        return(self.data["finished"])
+
+    def finish(self):
+        with self._lock:
+            self.data["finished"] = True
+            for rec in self.data["phases"].values():
+                rec.pop("secret", None)
+            self._save()
+
+    def forget(self, *phases):
+        with self._lock:
+            for phase in phases:
+                self.data["phases"].pop(phase, None)
+            self._save()
+
+    def reset(self, ident=None):
+        with self._lock:
+            self.data.update(ident=ident, finished=False, phases={})
+            self._save()
+
+    @classmethod
+    def forSite(cls, site, root=CACHE_DIR):
+        """Journal of a manifest site, keyed on its path, name and database"""
+        db = site.get("db_name", "") if site.get("nodb") else siteDbName(site["name"])
+        return(cls(os.path.abspath(site["path"]), root, f"{formatName(site['name'])}\n{db}"))
+
+def _siteIdent(site):
+    """Digest of what a manifest site asks for, a journal of another request is reset"""
+    what = {k: site.get(k) for k in ("name", "version", "locale", "table_prefix", "constants", "template", "nodb", "db_name")}
+    what["packages"] = sitePackages(site)
+    return(hashlib.sha1(json.dumps(what, sort_keys=True, default=str).encode()).hexdigest())
+
+def _filesInstalled(path, version):
+    return(os.path.isdir(path) and wpMarkerCount(os.listdir(path)) > 2 and readWpVersion(path) == version)
+
+def _configWritten(path, db_conf):
+    try:
+        with open(os.path.join(path, "wp-config.php"), "r", encoding="utf-8") as f:
+            cfg = WpConfig(f.read())
+    except OSError:
+        return(False)
+    return(all(cfg.get(k) == db_conf[k] for k in ("DB_NAME", "DB_USER", "DB_PASSWORD")))
+
+def _provisionDb(site, name, existing_dbs, release=None, journal=None):
+    db_host = site.get("db_host", "localhost")
+    if site.get("nodb"):
+        return({
+            'DB_NAME': site.get("db_name", ""),
+            'DB_USER': site.get("db_user", ""),
+            'DB_PASSWORD': site.get("db_password", ""),
+            'DB_HOST': db_host
+        })
+
+    template = None
+    if site.get("template"):
+        if isinstance(release, Future):
+            release = release.result()
+        prefix = site.get("table_prefix", "wp_")
+        template = templateName(release["wpv"]["version"], prefix)
+        if template not in existing_dbs:
+            raise InstallError(f"No template database '{template}', create it with --make-template")
+
+    journal = journal if journal is not None else InstallJournal()
+    dbn = siteDbName(name)
+    if not journal.has("db") and (dbn in existing_dbs or existing_dbs.hasUser(dbn)):
+        dropDb(dbn, dbn)
+
+    db_pass = createDb(dbn, dbn, template=template, journal=journal)
+    db_conf = {
+        'DB_NAME': dbn,
+        'DB_USER': dbn,
+        'DB_PASSWORD': db_pass,
+        'DB_HOST': db_host
+    }
+
+    if template is not None:
+        db_conf["admin_user"] = site.get("admin_user")
+        if journal.done("patch"):
+            db_conf["admin_password"] = journal.get("patch", "secret")
+        else:
+            db_conf["admin_password"] = site.get("admin_password") or genPassword(24)
+            patchSiteDb(dbn, prefix, site.get("url"), site.get("title"), db_conf["admin_user"], site.get("admin_email"), db_conf["admin_password"])
+            journal.complete("patch", secret=db_conf["admin_password"])
+
+    return(db_conf)
+
+def _abandonDb(site, name, db_f, journal, fresh):
+    """
+    Wait for the database of a failed install, and drop it again if it was created
+    by this run so that no database or user is left behind without a site.
+    """
+    try:
+        db_f.result()
+    except Exception:
+        pass
+    if site.get("nodb") or not fresh or not journal.has("db"):
+        return
+    dbn = siteDbName(name)
+    log(f"Dropping '{dbn}', created for the failed install of {site['name']}", "warning")
+    try:
+        dropDb(dbn, dbn)
+    except DbError as e:
+        log(f"Failed to drop '{dbn}': {e}", "error")
+        return
+    journal.forget("db", "user", "grant", "patch")
+
+def installSite(site, release, existing_dbs=None, deploy="extract", workers=None, keys=None, journal=None, packages=None, policy=None, remote_salts=False):
+    """
+    Non-interactive install of one manifest site.
+
+    release is a prepared release or a Future of one. Without keys, security keys are
+    generated locally, or fetched from the wordpress.org API with remote_salts. The
+    database (and the remote keys) are provisioned in the background while the files
+    are deployed, and only the wp-config write waits for all of them.
+
+    Phases recorded as done in the journal are skipped once checked, and the path and
+    database the journal owns don't count as conflicts. The journal starts over with
+    overwrite, or when it was written for another name, version, packages or
+    constants.
+    """
+    name = formatName(site["name"])
+    path = os.path.abspath(site["path"])
+    overwrite = site.get("overwrite", False)
+    journal = journal if journal is not None else InstallJournal()
+
+    ident = _siteIdent(site)
+    if overwrite or journal.data.get("ident") != ident:
+        journal.reset(ident)
+
+    if journal.finished():
+        version = journal.get("files", "version")
+        if _filesInstalled(path, version) and os.path.exists(os.path.join(path, "wp-config.php")):
+            return({"db": journal.get("db", "name", site.get("db_name", "")), "version": version, "admin_password": None, "resumed": "already installed"})
+        journal.reset()
+    resumed = bool(journal.data["phases"])
+
+    if os.path.exists(path) and not journal.has("files"):
+        ctn = os.listdir(path)
+        if ctn and not overwrite:
+            what = "a WP installation" if wpMarkerCount(ctn) > 2 else "files"
+            raise InstallError(f"'{path}' already contains {what}")
+
+    existing_dbs = existing_dbs if existing_dbs is not None else DbIndex()
+    if not site.get("nodb") and not overwrite and not journal.has("db"):
+        dbn = siteDbName(name)
+        if dbn in existing_dbs:
+            raise InstallError(f"There's already a database named '{dbn}'")
+        if existing_dbs.hasUser(dbn):
+            raise InstallError(f"There's already a database user named '{dbn}'")
+
+    fresh_db = not journal.has("db")
+    db_f = background(_provisionDb, site, name, existing_dbs, release, journal)
+    keys_f = background(fetchSecurityKeys, None, True) if keys is None and remote_salts else None
+    if keys is None and not remote_salts:
+        keys = fetchSecurityKeys()
+
+    try:
+        if isinstance(release, Future):
+            release = release.result()
+        version = release["wpv"]["version"]
+
+        if not (journal.done("files") and journal.get("files", "version") == version and _filesInstalled(path, version)):
+            journal.begin("files", version=version)
+            if os.path.exists(path):
+                # Nothing is removed until the database is known to be there
+                db_f.result()
+                shutil.rmtree(path)
+            deployRelease(release, path, deploy, workers, policy)
+            journal.complete("files", version=version)
+
+        specs = sitePackages(site)
+        if specs and not journal.done("packages"):
+            installed = installPackages(path, specs, packages or PackageCache(), workers, policy)
+            journal.complete("packages", installed=installed)
+
+        db_conf = db_f.result()
+    except Exception:
+        _abandonDb(site, name, db_f, journal, fresh_db)
+        raise
+    if keys_f is not None:
+        keys = keys_f.result()
+
+    if not (journal.done("config") and _configWritten(path, db_conf)):
+        wp_config = {"custom_constants": dict(site.get("constants", {}))}
+        if release.get("language"):
+            wp_config["custom_constants"].setdefault("WPLANG", release["language"]["locale"])
+        if "table_prefix" in site:
+            wp_config["table_prefix"] = site["table_prefix"]
+
+        result = writeWpConfig(path, db_conf, wp_config, False, keys)
+        if not result["success"]:
+            raise InstallError(result["message"])
+        journal.complete("config")
+
+    # The files already follow the policy, only what was written since is left
+    if policy is not None and not journal.done("permissions"):
+        applyPolicy(path, policy, workers, only=("wp-config.php",) + policy.writable)
+        journal.complete("permissions")
+
+    journal.finish()
+    return({"db": db_conf["DB_NAME"], "version": version, "admin_password": db_conf.get("admin_password"), "resumed": "resumed" if resumed else None})
+
+def runManifest(sites, cache, jobs=4, segments=1, deploy="extract", workers=None, remote_salts=False, inventory=None, policy=None):
+    """
+    Install every manifest site on a bounded pool of workers, never prompting.
+    With an inventory, a site whose database is used by an indexed site elsewhere
+    on the host is refused.
+    """
+    results = [{"name": st["name"], "path": os.path.abspath(st["path"]), "status": "pending", "message": "", "time": 0.0} for st in sites]
+
+    # Releases download while the first sites already provision their databases
+    releases = {}
+    for locale, version in sorted({(st.get("locale") or "", st.get("version") or "") for st in sites}):
+        releases[(locale, version)] = background(prepareRelease, cache, locale or None, segments, deploy, workers, version or None)
+
+    # One query for the whole manifest, every check below is a set lookup
+    existing = getDbAdmin().index(refresh=True) if any(not st.get("nodb") for st in sites) else DbIndex()
+
+    # Every package the manifest uses is downloaded once, while the sites start
+    packages = PackageCache(cache.root)
+    specs = [sp for st in sites for sp in sitePackages(st)]
+    if specs:
+        background(fetchPackages, packages, specs, jobs)
+
+    salts = [None] * len(sites) if remote_salts else generateSalts(len(sites))
+
+    seen = {}
+    todo = []
+    for i, st in enumerate(sites):
+        key = (results[i]["path"], None if st.get("nodb") else siteDbName(st["name"]))
+        users = [r for r in inventory.find(key[1]) if r != key[0]] if inventory is not None and key[1] is not None else []
+        if key[0] in seen or (key[1] is not None and key[1] in seen):
+            results[i].update(status="failed", message=f"Conflicts with site '{sites[seen.get(key[0], seen.get(key[1]))]['name']}' of the manifest")
+        elif users:
+            results[i].update(status="failed", message=f"Database '{key[1]}' is used by the site in {users[0]}")
+        else:
+            seen[key[0]] = i
+            if key[1] is not None:
+                seen[key[1]] = i
+            todo.append(i)
+
+    def work(i):
+        start = time.time()
+        try:
+            with TRACER.phase("site", site=sites[i]["name"]):
+                journal = InstallJournal.forSite(sites[i], cache.root)
+                out = installSite(sites[i], releases[(sites[i].get("locale") or "", sites[i].get("version") or "")], existing, deploy, workers, salts[i], journal, packages, policy, remote_salts)
+            results[i].update(status="ok", message=f"db {out['db']}, WordPress {out['version']}")
+            if out["resumed"]:
+                results[i]["message"] = f"{out['resumed']}, {results[i]['message']}"
+            if out["admin_password"]:
+                results[i]["message"] += f", admin password '{out['admin_password']}'"
+        except Exception as e:
+            results[i].update(status="failed", message=str(e))
+        results[i]["time"] = time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        list(pool.map(work, todo))
+
+    return(results)
+
+def reportProfile(summary=True, trace_file=None):
+    if summary:
+        print(f"\n⏱️ Profile\n")
+        TRACER.printSummary()
+    if trace_file:
+        TRACER.writeTrace(trace_file)
+        log(f"Trace written to {trace_file}")
+
+def printResults(results):
+    cols = ["name", "status", "time", "path", "message"]
+    rows = [[r["name"], r["status"], f"{r['time']:.1f}s", r["path"], r["message"]] for r in results]
+    widths = [max([len(c)] + [len(row[i]) for row in rows]) for i,c in enumerate(cols)]
+
+    print("  ".join(c.upper().ljust(w) for c,w in zip(cols, widths)))
+    for row in rows:
+        line = "  ".join(v.ljust(w) for v,w in zip(row, widths))
+        if row[1] == "ok":
+            print(f"{Colors.GREEN}{line}{Colors.NC}")
+        else:
+            print(f"{Colors.RED}{line}{Colors.NC}")
+
+
+
+def findWpRoots(patterns, inventory=None):
+    """
+    Absolute, de-duplicated site roots from a list of paths and glob patterns.
+    '@' stands for every site of the inventory (see Inventory), '@FILE' for those of
+    the inventory FILE.
+    """
+    roots = []
+    seen = set()
+    for pattern in patterns:
+        if pattern.startswith("@"):
+            matches = Inventory(pattern[1:] or inventory).find()
+        else:
+            matches = sorted(glob.glob(os.path.expanduser(pattern))) or [pattern]
+        for m in matches:
+            root = os.path.abspath(m)
+            if root in seen:
+                continue
+            seen.add(root)
+            roots.append(root)
+    return(roots)
+
+CLONE_EXCLUDES = [
+    "wp-content/cache",
+    "wp-content/upgrade",
+    "wp-content/wflogs",
+    "wp-content/updraft",
+    "wp-content/ai1wm-backups",
+    "wp-content/uploads/cache",
+    "wp-content/debug.log",
+    "*.log"
+]
+
+def _dbClientArgs(db_host):
+    """mysql/mysqldump connection options for a DB_HOST value ('host', 'host:port' or 'host:/socket')"""
+    host, sep, extra = (db_host or "localhost").partition(":")
+    args = [f"--host={host}"]
+    if extra.startswith("/"):
+        args.append(f"--socket={extra}")
+    elif extra:
+        args.append(f"--port={extra}")
+    return(args)
+
+def _streamDb(src_db, dest_name, admin):
+    """Pipe mysqldump of the source database into the mysql client, without a dump file"""
+    dump_cmd = ["mysqldump", *_dbClientArgs(src_db["DB_HOST"]), f"--user={src_db['DB_USER']}", "--single-transaction", "--quick", "--no-tablespaces", src_db["DB_NAME"]]
+    load_cmd = ["mysql", *admin.clientArgs(), dest_name]
+    env = dict(os.environ, MYSQL_PWD=src_db["DB_PASSWORD"] or "")
+
+    with TRACER.phase("db-stream", source=src_db["DB_NAME"]):
+        dump = subprocess.Popen(dump_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        load = subprocess.run(load_cmd, stdin=dump.stdout, capture_output=True)
+        dump.stdout.close()
+        dump_err = dump.stderr.read()
+        dump.wait()
+
+    if dump.returncode != 0:
+        raise InstallError(f"mysqldump failed: {dump_err.decode(errors='replace').strip()}")
+    if load.returncode != 0:
+        raise InstallError(f"mysql failed: {load.stderr.decode(errors='replace').strip()}")
+
+def _cloneDb(src_db, name, table_prefix, url=None, admin=None):
+    admin = admin or getDbAdmin()
+    host = src_db["DB_HOST"] or "localhost"
+    local = _isLocalDbHost(host)
+
+    dbn = siteDbName(name)
+    if local and src_db["DB_NAME"] in listDb(admin):
+        # Same server: tables are copied server side
+        db_pass = createDb(dbn, dbn, admin, template=src_db["DB_NAME"])
+    else:
+        db_pass = createDb(dbn, dbn, admin)
+        try:
+            _streamDb(src_db, dbn, admin)
+        except Exception:
+            dropDb(dbn, dbn, admin)
+            raise
+
+    if url:
+        patchSiteDb(dbn, table_prefix, url, admin=admin)
+
+    return({
+        'DB_NAME': dbn,
+        'DB_USER': dbn,
+        'DB_PASSWORD': db_pass,
+        'DB_HOST': "localhost"
+    })
+
+def cloneSite(src, dest, name=None, url=None, excludes=CLONE_EXCLUDES, mode="auto", overwrite=False, keys=None, admin=None, policy=None):
+    """
+    Staging copy of the site in src: files, database and a repointed wp-config.php.
+
+    Files are reflinked when the filesystem supports it and copied otherwise
+    (mode='hardlink' shares the core files with src, which WordPress updates would
+    then modify in both sites). The database wp_inst_<name> is cloned server side
+    when the source is on the same server, otherwise mysqldump is piped into it.
+    The database runs in the background while the files are copied. A
+    PermissionPolicy is applied to the copy, hardlinked files excepted.
+    """
+    src = os.path.abspath(src)
+    dest = os.path.abspath(dest)
+    name = formatName(name or os.path.basename(dest))
+    # Before any copy, a name MySQL can't take fails here
+    siteDbName(name)
+
+    if not os.path.isdir(src) or wpMarkerCount(os.listdir(src)) <= 2:
+        raise InstallError(f"'{src}' doesn't contain a WP installation")
+    if os.path.exists(dest):
+        ctn = os.listdir(dest)
+        if ctn and not overwrite:
+            what = "a WP installation" if wpMarkerCount(ctn) > 2 else "files"
+            raise InstallError(f"'{dest}' already contains {what}")
+
+    with open(os.path.join(src, "wp-config.php"), "r", encoding="utf-8") as f:
+        cfg = WpConfig(f.read())
+    src_db = {k: cfg.get(k) for k in ("DB_NAME", "DB_USER", "DB_PASSWORD", "DB_HOST")}
+    prefix = cfg.getTablePrefix() or "wp_"
+    if not src_db["DB_NAME"]:
+        raise InstallError(f"No DB_NAME in '{src}/wp-config.php'")
+
+    db_f = background(_cloneDb, src_db, name, prefix, url, admin)
+
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    stats = deployTree(src, dest, _policyDeployMode("reflink" if mode == "auto" else mode, policy), excludes)
+
+    db_conf = db_f.result()
+    result = writeWpConfig(dest, db_conf, {}, False, keys)
+    if not result["success"]:
+        raise InstallError(result["message"])
+
+    if policy is not None:
+        pst = applyPolicy(dest, policy)
+        if pst["linked"]:
+            log(f"{pst['linked']} hardlinked files of {dest} don't follow the permission policy", "warning")
+
+    return({"files": stats, "db": db_conf})
+
+def _rotatePlan(root, db_password):
+    config_file = os.path.join(root, 'wp-config.php')
+    with open(config_file, 'r', encoding='utf-8') as f:
+        cfg = WpConfig(f.read())
+
+    plan = {"root": root, "config": config_file, "cfg": cfg}
+    if db_password:
+        user = cfg.get("DB_USER")
+        if not user:
+            raise InstallError("No DB_USER in wp-config.php")
+        plan.update(db_user=user, db_host=cfg.get("DB_HOST") or "localhost", old_password=cfg.get("DB_PASSWORD"), new_password=genPassword(45))
+    return(plan)
+
+def _isLocalDbHost(db_host):
+    """Whether a DB_HOST (host, host:port or host:socket) is the local server"""
+    host = db_host.strip()
+    if host.startswith("["):
+        host = host[1:].split("]")[0]
+    elif host.count(":") == 1:
+        host = host.split(":")[0]
+    return(host in ("", "localhost", "127.0.0.1", "::1"))
+
+def _saveRotation(path, plans):
+    """
+    Password plan of a rotation, written before the server is changed and kept
+    after each step, in a file only its owner can read.
+    """
+    data = [{k: p.get(k) for k in ("root", "db_user", "db_host", "old_password", "new_password", "state")} for p in plans]
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _rotateWrite(plan, salts, constants, backup, keys=None, backup_root=CACHE_DIR):
+    cfg = plan["cfg"]
+    for name, value in constants.items():
+        cfg.set(name, value, "wp")
+    # After the constants, DB_PASSWORD must be the one the server now expects
+    if "new_password" in plan:
+        cfg.set("DB_PASSWORD", plan["new_password"], "db")
+    if salts:
+        _replace_security_keys(cfg, keys)
+
+    validation = cfg.validate()
+    if not validation["valid"]:
+        raise InstallError(validation["error"])
+
+    backup_file = _backupConfig(plan["config"], backup_root) if backup else None
+    with TRACER.phase("config") as ph:
+        content = cfg.render()
+        atomicWrite(plan["config"], content)
+        ph["bytes"] = len(content)
+    return(backup_file)
+
+def rotateConfigs(roots, salts=True, db_password=False, constants=None, backup=False, jobs=8, db_user_host="localhost", admin=None, remote_salts=False, journal_root=CACHE_DIR):
+    """
+    Rewrite the wp-config.php of many sites in parallel.
+
+    Salts and constants are replaced in place. With db_password, every database user
+    gets a new password, shared by the sites using it: all the ALTER USER statements
+    run on one admin session first, and if none of a user's configs can be written
+    afterwards its previous password is restored. The plan, passwords included, is
+    journaled under <journal_root>/journal before the server is changed and removed
+    once every site is either written or restored. Sites whose DB_HOST isn't the
+    local server fail, as the admin can't reach them. Backups go to
+    <journal_root>/backups (see _backupConfig). New salts are generated for all
+    sites at once unless remote_salts asks for the wordpress.org API.
+    """
+    constants = constants or {}
+    results = {root: {"name": os.path.basename(root) or root, "path": root, "status": "pending", "message": "", "time": 0.0} for root in roots}
+    journal = None
+
+    def fail(root, e):
+        results[root].update(status="failed", message=str(e))
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        plans = []
+        for root, fut in [(r, pool.submit(_rotatePlan, r, db_password)) for r in roots]:
+            try:
+                plans.append(fut.result())
+            except Exception as e:
+                fail(root, e)
+
+        if db_password:
+            local = [p for p in plans if _isLocalDbHost(p["db_host"])]
+            for p in plans:
+                if p not in local:
+                    fail(p["root"], InstallError(f"DB_HOST '{p['db_host']}' isn't the local database server"))
+            plans = local
+
+        if db_password and plans:
+            admin = admin or getDbAdmin()
+            jdir = os.path.join(journal_root, "journal")
+            os.makedirs(jdir, mode=0o700, exist_ok=True)
+            journal = os.path.join(jdir, f"rotate-{int(time.time())}-{os.getpid()}.json")
+            journaled = plans
+            # Sites sharing a database user share its new password, set once
+            users = {}
+            for p in journaled:
+                users.setdefault(p["db_user"], []).append(p)
+                p.update(new_password=users[p["db_user"]][0]["new_password"], state="planned")
+            _saveRotation(journal, journaled)
+
+            changed = []
+            try:
+                with admin.session() as s:
+                    for user, group in users.items():
+                        try:
+                            s.setPassword(user, group[0]["new_password"], db_user_host)
+                        except DbError as e:
+                            for p in group:
+                                fail(p["root"], e)
+                            continue
+                        for p in group:
+                            p["state"] = "altered"
+                        changed += group
+            except DbError as e:
+                for p in plans:
+                    if p not in changed:
+                        fail(p["root"], e)
+            _saveRotation(journal, journaled)
+            plans = changed
+
+        if salts and not remote_salts:
+            for p, keys in zip(plans, generateSalts(len(plans))):
+                p["keys"] = keys
+
+        def work(p):
+            start = time.time()
+            try:
+                keys = p.get("keys") or (fetchSecurityKeys(None, True) if salts else None)
+                backup_file = _rotateWrite(p, salts, constants, backup, keys, journal_root)
+                if "state" in p:
+                    p["state"] = "written"
+                results[p["root"]].update(status="ok", message=f"backup {backup_file}" if backup_file else "")
+            except Exception as e:
+                fail(p["root"], e)
+            results[p["root"]]["time"] = time.time() - start
+
+        list(pool.map(work, plans))
+
+    groups = {}
+    for p in plans:
+        if "new_password" in p:
+            groups.setdefault(p["db_user"], []).append(p)
+    # A password is only restored when no site of its user was written with the new one
+    rollback = {u: g for u, g in groups.items() if all(results[p["root"]]["status"] != "ok" for p in g)}
+    for u, group in groups.items():
+        if u not in rollback:
+            for p in group:
+                if results[p["root"]]["status"] != "ok":
+                    results[p["root"]]["message"] += f" (database password kept for the other sites of '{u}', new password is {p['new_password']})"
+    if rollback:
+        with admin.session() as s:
+            for user, group in rollback.items():
+                try:
+                    s.setPassword(user, group[0]["old_password"] or "", db_user_host)
+                    for p in group:
+                        p["state"] = "restored"
+                        results[p["root"]]["message"] += " (database password restored)"
+                except DbError as e:
+                    for p in group:
+                        results[p["root"]]["message"] += f" (database password NOT restored: {e}, new password is {p['new_password']})"
+
+    if journal is not None:
+        if any(p["state"] == "altered" for p in journaled):
+            _saveRotation(journal, journaled)
+            log(f"Some database passwords were changed without their config, the plan is kept in {journal}", "warning")
+        else:
+            os.remove(journal)
+
+    return([results[r] for r in roots])
+
+def fetchChecksums(version, locale=None, session=None):
+    """{relative path: md5} of a release from the wordpress.org checksums API"""
+    http = session or httpClient()
+    with TRACER.phase("checksums-api", version=version):
+        r = http.get(WP_CHECKSUMS_URL, params={"version": version, "locale": locale or "en_US"}, timeout=10)
+    r.raise_for_status()
+    sums = r.json().get("checksums")
+    if not sums:
+        raise InstallError(f"No checksums published for WordPress {version} ({locale or 'en_US'})")
+    return(sums)
+
+def releaseChecksums(version, locale=None, cache=None, source="auto"):
+    """
+    Checksums of a release, from its archive when the cache holds it ('archive'),
+    from the API ('api'), or the archive first then the API ('auto').
+    """
+    if source in ("auto", "archive") and cache is not None:
+        archive = cache.get(version, locale or "en_US")
+        if archive is not None:
+            return(cache.checksums(archive))
+        if source == "archive":
+            raise InstallError(f"WordPress {version} ({locale or 'en_US'}) isn't in the cache")
+    return(fetchChecksums(version, locale))
+
+class HashCache:
+    """
+    md5 of the files of one site, keyed on (inode, size, mtime) so that a file only
+    gets hashed again once it changed. Stored outside of the site, in <root>/hashes.
+    """
+
+    def __init__(self, site, root=CACHE_DIR):
+        os.makedirs(os.path.join(root, "hashes"), exist_ok=True)
+        self.path = os.path.join(root, "hashes", f"{hashlib.sha1(site.encode()).hexdigest()}.json")
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def get(self, rel, st):
+        e = self.entries.get(rel)
+        if e is not None and e[:3] == [st.st_ino, st.st_size, st.st_mtime_ns]:
+            return(e[3])
+        return(None)
+
+    def put(self, rel, st, md5):
+        self.entries[rel] = [st.st_ino, st.st_size, st.st_mtime_ns, md5]
+
+    def save(self, keep):
+        self.entries = {k: v for k, v in self.entries.items() if k in keep}
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+def verifySite(root, checksums, cache_root=CACHE_DIR, workers=None):
+    """
+    Compare the core files of the site in root with a release's checksums.
+
+    wp-content is left out, like wp-config.php and the other site files at the root;
+    files wp-admin and wp-includes have but the release doesn't are reported as
+    unknown. Only files changed since the previous scan are hashed again.
+    Returns a dict {checked, hashed, modified: [...], missing: [...], unknown: [...]}.
+    """
+    report = {"checked": 0, "hashed": 0, "modified": [], "missing": [], "unknown": []}
+    hashes = HashCache(root, cache_root)
+
+    with TRACER.phase("verify") as ph:
+        present = _treeFiles(root, SYNC_KEEP)
+        expected = {rel.replace("/", os.sep): md5 for rel, md5 in checksums.items() if not rel.startswith("wp-content/")}
+
+        todo = []
+        for rel, md5 in expected.items():
+            e = present.get(rel)
+            if e is None:
+                report["missing"].append(rel)
+                continue
+            st = e.stat()
+            known = hashes.get(rel, st)
+            if known is None:
+                todo.append((rel, e, st))
+            elif known != md5:
+                report["modified"].append(rel)
+            report["checked"] += 1
+
+        def digest(item):
+            rel, e, st = item
+            return(rel, st, fileHash(e.path, "md5"))
+
+        with ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 1) + 2)) as pool:
+            for rel, st, md5 in pool.map(digest, todo):
+                hashes.put(rel, st, md5)
+                if md5 != expected[rel]:
+                    report["modified"].append(rel)
+                ph["bytes"] += st.st_size
+
+        for rel in present:
+            if rel not in expected and rel.split(os.sep, 1)[0] in SYNC_CORE_DIRS:
+                report["unknown"].append(rel)
+
+        report["hashed"] = len(todo)
+        ph["items"] = report["checked"]
+
+    hashes.save(expected)
+    for k in ("modified", "missing", "unknown"):
+        report[k].sort()
+    return(report)
+
+def verifySites(roots, cache=None, source="auto", jobs=4, workers=None):
+    """verifySite() on many sites, each against the release its version.php names"""
+    cache_root = cache.root if cache is not None else CACHE_DIR
+    sums = {}
+    sums_lock = threading.Lock()
+
+    def work(root):
+        res = {"name": os.path.basename(root) or root, "path": root, "status": "pending", "message": "", "time": 0.0}
+        start = time.time()
+        try:
+            version = readWpVersion(root)
+            if version is None:
+                raise InstallError("No WordPress version found (wp-includes/version.php)")
+            locale = readWpLocale(root)
+            with sums_lock:
+                if (version, locale) not in sums:
+                    sums[(version, locale)] = releaseChecksums(version, locale, cache, source)
+            rep = verifySite(root, sums[(version, locale)], cache_root, workers)
+
+            bad = [f"{len(rep[k])} {k}" for k in ("modified", "missing", "unknown") if rep[k]]
+            res["status"] = "tampered" if bad else "ok"
+            res["message"] = f"WordPress {version}, {rep['checked']} files ({rep['hashed']} hashed)"
+            if bad:
+                res["message"] += ": " + ", ".join(bad) + " (" + ", ".join((rep["modified"] + rep["missing"] + rep["unknown"])[:3]) + ")"
+            res["report"] = rep
+        except Exception as e:
+            res.update(status="failed", message=str(e))
+        res["time"] = time.time() - start
+        return(res)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return(list(pool.map(work, roots)))
+
+class JobRejected(InstallError):
+    """A job the daemon refuses, with the HTTP status to answer"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class Provisioner:
+    """
+    Job runner of the serve daemon.
+
+    install, clone, rotate and verify jobs wait in a bounded queue for a fixed pool
+    of workers, and share the HTTP session, the DB admin pool and the prepared
+    releases (kept in memory as long as the version-check answer is fresh). Two jobs
+    can't target the same site path at once, and with roots every path a job names
+    must be below one of them. Jobs can only overwrite a site with allow_overwrite,
+    and an install never takes a database the inventory gives to another site.
+    Jobs only change under the lock, and are handed out as copies taken under it.
+    """
+
+    JOB_TYPES = ("install", "clone", "rotate", "verify")
+
+    def __init__(self, cache, jobs=4, queue_size=64, segments=1, deploy="auto", workers=None, inventory=None, keep=1000, policy=None, roots=None, allow_overwrite=False):
+        self.cache = cache
+        self.policy = policy
+        self.allow_overwrite = allow_overwrite
+        self.roots = [os.path.realpath(r) for r in roots] if roots else None
+        self.segments = segments
+        self.deploy = deploy
+        self.workers = workers
+        self.inventory = inventory
+        self.keep = keep
+
+        self.packages = PackageCache(cache.root)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.jobs = {}
+        self.busy = set()
+        self._releases = {}
+        self._lock = threading.Lock()
+
+        for _ in range(max(1, jobs)):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def release(self, locale=None, version=None):
+        """Future of the prepared release, shared by the jobs until its version check expires"""
+        key = (locale or "", version or "")
+        with self._lock:
+            ent = self._releases.get(key)
+            stale = ent is None or time.time() - ent[0] > self.cache.versions.ttl
+            if stale or (ent[1].done() and ent[1].exception() is not None):
+                ent = (time.time(), background(prepareRelease, self.cache, locale, self.segments, self.deploy, self.workers, version))
+                self._releases[key] = ent
+        return(ent[1])
+
+    def _allowed(self, *paths):
+        if self.roots is None:
+            return
+        for path in paths:
+            real = os.path.realpath(path)
+            if not any(real != r and os.path.commonpath([r, real]) == r for r in self.roots):
+                raise JobRejected(f"'{path}' isn't below the roots of the daemon", 403)
+
+    def _targets(self, kind, params):
+        if params.get("overwrite") and not self.allow_overwrite:
+            raise JobRejected("This daemon doesn't overwrite sites", 403)
+        if kind == "install":
+            if not params.get("name") or not params.get("path"):
+                raise JobRejected("An install job needs a 'name' and a 'path'")
+            self._allowed(params["path"])
+            try:
+                sitePackages(params)
+                if not params.get("nodb"):
+                    siteDbName(params["name"])
+                    if not _isLocalDbHost(params.get("db_host", "localhost")):
+                        raise InstallError(f"db_host '{params['db_host']}' isn't the local server, use nodb")
+            except InstallError as e:
+                raise JobRejected(str(e))
+            return({os.path.abspath(params["path"])})
+        if kind == "clone":
+            if not params.get("src") or not params.get("dest"):
+                raise JobRejected("A clone job needs a 'src' and a 'dest'")
+            self._allowed(params["src"], params["dest"])
+            return({os.path.abspath(params["dest"])})
+        if not params.get("roots"):
+            raise JobRejected(f"A {kind} job needs 'roots'")
+        self._allowed(*params["roots"])
+        return(set())
+
+    def job(self, job_id):
+        """Copy of a job, None if it isn't kept"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return(dict(job) if job is not None else None)
+
+    def listJobs(self):
+        """Copies of every job kept, without their results"""
+        with self._lock:
+            return([{k: v for k, v in j.items() if k != "result"} for j in self.jobs.values()])
+
+    def health(self):
+        with self._lock:
+            running = sum(1 for j in self.jobs.values() if j["status"] == "running")
+        return({"status": "ok", "queued": self.queue.qsize(), "running": running})
+
+    def submit(self, kind, params):
+        if kind not in self.JOB_TYPES:
+            raise JobRejected(f"Unknown job type '{kind}'")
+        targets = self._targets(kind, params)
+
+        job = {"id": secrets.token_hex(8), "type": kind, "status": "queued", "submitted": time.time(),
+               "started": None, "finished": None, "result": None, "error": None}
+        with self._lock:
+            if targets & self.busy:
+                raise JobRejected(f"A job on {', '.join(sorted(targets & self.busy))} is already queued or running", 409)
+            try:
+                self.queue.put_nowait((job, params, targets))
+            except queue.Full:
+                raise JobRejected("The job queue is full", 503)
+            self.busy |= targets
+            self.jobs[job["id"]] = job
+
+            done = [i for i, j in self.jobs.items() if j["finished"] is not None]
+            for i in done[:max(0, len(self.jobs) - self.keep)]:
+                del self.jobs[i]
+            return(dict(job))
+
+    def _worker(self):
+        while True:
+            job, params, targets = self.queue.get()
+            with self._lock:
+                job.update(status="running", started=time.time())
+            outcome = {}
+            try:
+                with TRACER.phase("job", type=job["type"]):
+                    outcome["result"] = getattr(self, f"_{job['type']}")(params)
+                outcome["status"] = "ok"
+            except Exception as e:
+                outcome.update(status="failed", error=str(e))
+            finally:
+                with self._lock:
+                    job.update(outcome, finished=time.time())
+                    self.busy -= targets
+                self.queue.task_done()
+
+    def _install(self, site):
+        path = os.path.abspath(site["path"])
+        if not site.get("nodb") and self.inventory and os.path.exists(self.inventory):
+            dbn = siteDbName(site["name"])
+            users = [r for r in Inventory(self.inventory).find(dbn) if r != path]
+            if users:
+                raise InstallError(f"Database '{dbn}' is used by the site in {users[0]}")
+        existing = getDbAdmin().index(refresh=True) if not site.get("nodb") else DbIndex()
+        journal = InstallJournal.forSite(site, self.cache.root)
+        release = self.release(site.get("locale"), site.get("version"))
+        return(installSite(site, release, existing, site.get("deploy", self.deploy), self.workers, generateSalts(1)[0], journal, self.packages, self.policy))
+
+    def _clone(self, p):
+        out = cloneSite(p["src"], p["dest"], p.get("name"), p.get("url"), CLONE_EXCLUDES + p.get("exclude", []), p.get("mode", "auto"), p.get("overwrite", False), policy=self.policy)
+        return({"files": out["files"], "db": out["db"]["DB_NAME"]})
+
+    def _rotate(self, p):
+        roots = findWpRoots(p["roots"], self.inventory)
+        return(rotateConfigs(roots, p.get("salts", True), p.get("db_password", False), p.get("constants", {}), p.get("backup", False), journal_root=self.cache.root))
+
+    def _verify(self, p):
+        return(verifySites(findWpRoots(p["roots"], self.inventory), self.cache, p.get("checksums", "auto"), workers=self.workers))
+
+class ApiHandler:
+    """
+    JSON API of the serve daemon:
+        POST /jobs        {"type": "install"|"clone"|"rotate"|"verify", ...}  -> 202 job
+        GET  /jobs        every job kept
+        GET  /jobs/<id>   one job, with its result once finished
+        GET  /health      queue state
+
+    When the server has a token, every request must carry it as
+    'Authorization: Bearer <token>'.
+
+    makeServer() mixes it into http.server's request handler, which is only
+    imported when the daemon starts.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        token = self.server.token
+        if token is None:
+            return(True)
+        if secrets.compare_digest(self.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+            return(True)
+        self._reply(401, {"error": "Missing or wrong token"})
+        return(False)
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        prov = self.server.provisioner
+        path = self.path.split("?")[0].rstrip("/")
+
+        if path == "/health":
+            return(self._reply(200, prov.health()))
+        if path == "/jobs":
+            return(self._reply(200, prov.listJobs()))
+        if path.startswith("/jobs/"):
+            job = prov.job(path[len("/jobs/"):])
+            if job is None:
+                return(self._reply(404, {"error": "Unknown job"}))
+            return(self._reply(200, job))
+        self._reply(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            return(self._reply(404, {"error": "Not found"}))
+
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            kind = data.pop("type")
+        except (ValueError, KeyError, AttributeError, TypeError):
+            return(self._reply(400, {"error": "Expected a JSON object with a 'type'"}))
+
+        try:
+            job = self.server.provisioner.submit(kind, data)
+        except JobRejected as e:
+            return(self._reply(e.status, {"error": str(e)}))
+        self._reply(202, job)
+
+def makeServer(address, provisioner, token=None):
+    """
+    HTTP server of the daemon on 'host:port' or 'unix:/path/to.sock'. Over TCP,
+    requests must carry token (see ApiHandler).
+    """
+    if token is None and not address.startswith("unix:"):
+        raise InstallError("The daemon only listens on TCP with a token")
+    import http.server
+    import socketserver
+
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            conn, _ = super().get_request()
+            # BaseHTTPRequestHandler expects a (host, port) client address
+            return(conn, ("unix", 0))
+
+    handler = type("ApiHandler", (ApiHandler, http.server.BaseHTTPRequestHandler), {})
+    if address.startswith("unix:"):
+        sock = address[len("unix:"):]
+        if os.path.exists(sock):
+            os.remove(sock)
+        srv = _UnixHTTPServer(sock, handler)
+        os.chmod(sock, 0o660)
+    else:
+        host, _, port = address.rpartition(":")
+        srv = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+        srv.daemon_threads = True
+    srv.provisioner = provisioner
+    srv.token = token
+    return(srv)
+
+def _parseConstant(arg):
+    name, sep, value = arg.partition("=")
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(f"Expected NAME=VALUE, got '{arg}'")
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return((name.strip(), value))
+
+
+# Options of the former single command line, each selecting a command
+_LEGACY_COMMANDS = {"--rotate": "config", "--verify": "verify", "--scan": "scan", "--clone": "clone", "--make-template": "template", "--serve": "serve"}
+COMMANDS = ("install", "config", "rotate", "verify", "scan", "clone", "template", "perms", "serve")
+
+def _legacyArgv(argv):
+    """Command line of the former flag style (--verify ROOT...), install being the default command"""
+    if argv and (argv[0] in COMMANDS or argv[0] in ("-h", "--help")):
+        return(argv)
+    for i, arg in enumerate(argv):
+        flag, sep, value = arg.partition("=")
+        if flag in _LEGACY_COMMANDS:
+            return([_LEGACY_COMMANDS[flag]] + argv[:i] + ([value] if sep else []) + argv[i + 1:])
+    return(["install"] + argv)
+
+def _releaseCache(args):
+    return(ReleaseCache(
+        args.cache_dir,
+        max_entries=args.cache_max_entries,
+        max_bytes=args.cache_max_size * 1024 * 1024 if args.cache_max_size else None,
+        version_ttl=args.version_ttl
+    ))
+
+def _inventoryFile(args):
+    return(args.inventory or os.path.join(args.cache_dir, "inventory.json"))
+
+def _cmdServe(args):
+    configureHttp(pool_size=max(16, args.jobs * args.segments))
+    try:
+        policy = _policyFromArgs(args)
+    except InstallError as e:
+        log(str(e), "error")
+        exit(1)
+    prov = Provisioner(_releaseCache(args), args.jobs, args.queue_size, args.segments, args.deploy, args.workers, _inventoryFile(args), policy=policy, roots=args.root, allow_overwrite=args.allow_overwrite)
+    token = None
+    if args.token_file:
+        with open(args.token_file, "r") as f:
+            token = f.read().strip()
+    try:
+        srv = makeServer(args.address, prov, token)
+    except InstallError as e:
+        log(str(e), "error")
+        exit(1)
+    log(f"Listening on {args.address} with {args.jobs} workers", "success")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        if args.address.startswith("unix:") and os.path.exists(args.address[len("unix:"):]):
+            os.remove(args.address[len("unix:"):])
+    exit(0)
+
+def _cmdConfig(args):
+    roots = findWpRoots(args.roots, _inventoryFile(args))
+    print(f"🔑 Rotating the configuration of {len(roots)} sites with {args.jobs} workers\n")
+    results = rotateConfigs(roots, not args.no_salts, args.rotate_db_password, dict(args.set), args.backup, args.jobs, remote_salts=args.remote_salts, journal_root=args.cache_dir)
+    printResults(results)
+    exit(0 if all(r["status"] == "ok" for r in results) else 1)
+
+def _cmdScan(args):
+    inventory = Inventory(_inventoryFile(args))
+    roots = inventory.scan(args.roots, args.max_depth, args.jobs)
+    printInventory(inventory, roots)
+    print(f"\n{len(roots)} WordPress installs, inventory written to {inventory.path}")
+    exit(0)
+
+def _cmdVerify(args):
+    configureHttp(pool_size=max(16, args.jobs))
+    roots = findWpRoots(args.roots, _inventoryFile(args))
+    print(f"🔍 Verifying the core files of {len(roots)} sites with {args.jobs} workers\n")
+    results = verifySites(roots, _releaseCache(args), args.checksums, args.jobs, args.workers)
+    printResults(results)
+    exit(0 if all(r["status"] == "ok" for r in results) else 1)
+
+def _cmdClone(args):
+    print(f"🐑 Cloning {os.path.abspath(args.src)} to {os.path.abspath(args.path)}\n")
+    try:
+        out = cloneSite(args.src, args.path, args.name, args.url, CLONE_EXCLUDES + args.exclude, args.deploy, policy=_policyFromArgs(args))
+    except (OSError, InstallError) as e:
+        log(f"Clone failed: {e}", "error")
+        exit(1)
+    st = out["files"]
+    log(f"{st['reflink']} reflinked, {st['hardlink']} hardlinked and {st['copy']} copied files, database '{out['db']['DB_NAME']}'", "success")
+    exit(0)
+
+def _policyFromArgs(args):
+    """PermissionPolicy of --owner and the mode options, None when none is given"""
+    modes = {"file_mode": args.file_mode, "dir_mode": args.dir_mode, "config_mode": args.config_mode}
+    if args.owner is None and all(m is None for m in modes.values()):
+        return(None)
+    return(PermissionPolicy.fromSpec(args.owner, **modes))
+
+def _cmdPerms(args):
+    try:
+        policy = _policyFromArgs(args) or PermissionPolicy()
+    except InstallError as e:
+        log(str(e), "error")
+        exit(1)
+    roots = findWpRoots(args.roots, _inventoryFile(args))
+    print(f"🔒 Applying the permission policy to {len(roots)} sites\n")
+    ok = True
+    for root in roots:
+        try:
+            st = applyPolicy(root, policy, args.workers)
+            log(f"{root}: {st['checked']} checked, {st['chown']} chowned, {st['chmod']} chmoded, {st['linked']} hardlinked files left alone", "warning" if st["linked"] else "success")
+        except (OSError, InstallError) as e:
+            log(f"{root}: {e}", "error")
+            ok = False
+    exit(0 if ok else 1)
+
+def _cmdTemplate(args):
+    ok = True
+    for root in findWpRoots(args.roots, _inventoryFile(args)):
+        try:
+            log(f"Template '{makeTemplate(root)}' created from {root}", "success")
+        except (OSError, InstallError) as e:
+            log(f"{root}: {e}", "error")
+            ok = False
+    exit(0 if ok else 1)
+
+def buildParser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--jobs", "-j", type=int, help="Nombre de tâches simultanées", required=False, default=4)
+    common.add_argument("--workers", type=int, help="Nombre de threads pour l'extraction et les sommes de contrôle", required=False, default=None)
+    common.add_argument("--db-admin-cnf", help="Fichier d'options MySQL ([client]) du compte administrateur", required=False, default=None)
+    common.add_argument("--db-admin-socket", help="Socket MySQL pour l'authentification par socket", required=False, default=None)
+    common.add_argument("--inventory", help="Fichier d'inventaire des sites (scan, '@' dans les listes de sites)", required=False, default=None)
+    common.add_argument("--version-ttl", type=int, help="Durée de validité du cache de la vérification de version (secondes)", required=False, default=VERSION_TTL)
+    common.add_argument("--cache-dir", help="Dossier du cache des archives WordPress", required=False, default=CACHE_DIR)
+    common.add_argument("--cache-max-entries", type=int, help="Nombre maximum d'archives gardées en cache", required=False, default=None)
+    common.add_argument("--cache-max-size", type=int, help="Taille maximum du cache (Mo)", required=False, default=None)
+    common.add_argument("--profile", action="store_true", help="Affiche le temps passé dans chaque phase", required=False, default=False)
+    common.add_argument("--trace", help="Écrit les phases chronométrées dans un fichier JSON (format Chrome trace)", required=False, default=None)
+
+    octal = lambda v: int(v, 8)
+    perms = argparse.ArgumentParser(add_help=False)
+    perms.add_argument("--owner", metavar="USER[:GROUP]", help="Propriétaire des fichiers du site, ex: www-data", required=False, default=None)
+    perms.add_argument("--file-mode", type=octal, help="Droits des fichiers (644 par défaut)", required=False, default=None)
+    perms.add_argument("--dir-mode", type=octal, help="Droits des dossiers (755 par défaut)", required=False, default=None)
+    perms.add_argument("--config-mode", type=octal, help="Droits de wp-config.php (640 avec --owner, 644 sinon)", required=False, default=None)
+
+    parser = argparse.ArgumentParser(add_help=True, description="Installation et maintenance de sites WordPress")
+    sub = parser.add_subparsers(dest="command", metavar="COMMANDE", required=True)
+
+    p = sub.add_parser("install", parents=[common, perms], help="Installe un site (interactif) ou les sites d'un manifeste")
+    p.add_argument("--name", help="Nom du projet", required=False, default=None)
+    p.add_argument("--path", help="Chemin du site WP", required=False, default=None)
+    p.add_argument("--nodb", "-n", action="store_true", help="Ne crée pas de base de données", required=False, default=False)
+    p.add_argument("--segments", type=int, help="Nombre de segments parallèles pour le téléchargement", required=False, default=1)
+    p.add_argument("--deploy", choices=["extract", "auto", "reflink", "hardlink", "copy"], help="Déploiement depuis l'archive (extract) ou depuis l'arbre partagé du cache", required=False, default="extract")
+    p.add_argument("--manifest", help="Fichier JSON de sites à installer sans interaction", required=False, default=None)
+    p.add_argument("--template", action="store_true", help="Clone les bases depuis le modèle de la version (--manifest)", required=False, default=False)
+    p.add_argument("--plugin", action="append", metavar="SLUG[@VERSION]", help="Extension à installer depuis wordpress.org (répétable)", required=False, default=[])
+    p.add_argument("--theme", action="append", metavar="SLUG[@VERSION]", help="Thème à installer depuis wordpress.org (répétable)", required=False, default=[])
+    p.add_argument("--locale", help="Langue de WordPress, ex: fr_FR (version localisée ou pack de langue)", required=False, default=None)
+    p.add_argument("--wp-version", help="Version de WordPress à installer (dernière version par défaut)", required=False, default=None)
+    p.add_argument("--remote-salts", action="store_true", help="Récupère les clés de sécurité sur api.wordpress.org au lieu de les générer localement", required=False, default=False)
+    p.set_defaults(func=_cmdInstall)
+
+    p = sub.add_parser("config", aliases=["rotate"], parents=[common], help="Réécrit le wp-config.php des sites donnés")
+    p.add_argument("roots", nargs="+", metavar="ROOT", help="Chemins ou motifs glob des sites, '@' pour l'inventaire")
+    p.add_argument("--rotate-db-password", action="store_true", help="Change aussi le mot de passe de base de données", required=False, default=False)
+    p.add_argument("--no-salts", action="store_true", help="Ne régénère pas les clés de sécurité", required=False, default=False)
+    p.add_argument("--set", type=_parseConstant, action="append", metavar="NAME=VALUE", help="Constante à définir, VALUE en JSON ou texte", required=False, default=[])
+    p.add_argument("--remote-salts", action="store_true", help="Récupère les clés de sécurité sur api.wordpress.org au lieu de les générer localement", required=False, default=False)
+    p.add_argument("--backup", action="store_true", help="Garde une copie des wp-config.php modifiés", required=False, default=False)
+    p.set_defaults(func=_cmdConfig)
+
+    p = sub.add_parser("verify", parents=[common], help="Vérifie les fichiers du cœur des sites donnés")
+    p.add_argument("roots", nargs="+", metavar="ROOT", help="Chemins ou motifs glob des sites, '@' pour l'inventaire")
+    p.add_argument("--checksums", choices=["auto", "archive", "api"], help="Source des sommes de contrôle", required=False, default="auto")
+    p.set_defaults(func=_cmdVerify)
+
+    p = sub.add_parser("scan", parents=[common], help="Recherche les installations WordPress et met à jour l'inventaire")
+    p.add_argument("roots", nargs="+", metavar="ROOT", help="Dossiers à parcourir")
+    p.add_argument("--max-depth", type=int, help="Profondeur maximum de la recherche", required=False, default=4)
+    p.set_defaults(func=_cmdScan)
+
+    p = sub.add_parser("clone", parents=[common, perms], help="Copie un site (fichiers et base) vers --path")
+    p.add_argument("src", metavar="SRC", help="Site à copier")
+    p.add_argument("--path", help="Chemin du nouveau site", required=True)
+    p.add_argument("--name", help="Nom du projet", required=False, default=None)
+    p.add_argument("--url", help="URL du site cloné", required=False, default=None)
+    p.add_argument("--exclude", action="append", metavar="PATTERN", help="Chemin à ne pas copier, en plus des caches", required=False, default=[])
+    p.add_argument("--deploy", choices=["auto", "reflink", "hardlink", "copy"], help="Mode de copie des fichiers", required=False, default="auto")
+    p.set_defaults(func=_cmdClone)
+
+    p = sub.add_parser("template", parents=[common], help="Enregistre la base des sites donnés comme modèle de leur version et préfixe")
+    p.add_argument("roots", nargs="+", metavar="ROOT", help="Chemins ou motifs glob des sites, '@' pour l'inventaire")
+    p.set_defaults(func=_cmdTemplate)
+
+    p = sub.add_parser("perms", parents=[common, perms], help="Applique les propriétaires et droits aux sites donnés")
+    p.add_argument("roots", nargs="+", metavar="ROOT", help="Chemins ou motifs glob des sites, '@' pour l'inventaire")
+    p.set_defaults(func=_cmdPerms)
+
+    p = sub.add_parser("serve", parents=[common, perms], help="Démarre le service d'installation")
+    p.add_argument("address", metavar="ADDR", help="hôte:port ou unix:/chemin.sock")
+    p.add_argument("--root", action="append", metavar="DIR", help="Répertoire sous lequel les tâches peuvent écrire (répétable)", required=True)
+    p.add_argument("--token-file", metavar="FICHIER", help="Fichier du jeton exigé des clients (obligatoire en TCP)", required=False, default=None)
+    p.add_argument("--allow-overwrite", action="store_true", help="Autorise les tâches à écraser un site existant", required=False, default=False)
+    p.add_argument("--queue-size", type=int, help="Nombre maximum de tâches en attente", required=False, default=64)
+    p.add_argument("--segments", type=int, help="Nombre de segments parallèles pour le téléchargement", required=False, default=1)
+    p.add_argument("--deploy", choices=["auto", "reflink", "hardlink", "copy"], help="Déploiement depuis l'arbre partagé du cache", required=False, default="auto")
+    p.set_defaults(func=_cmdServe)
+    return(parser)
+
+def _cmdInstall(args):
+    print(f"Args: {args}\n")
+    configureHttp(pool_size=max(16, args.jobs * args.segments))
+    cache = _releaseCache(args)
+    try:
+        policy = _policyFromArgs(args)
+    except InstallError as e:
+        log(str(e), "error")
+        exit(1)
+
+    if args.manifest != None:
+        try:
+            sites = loadManifest(args.manifest)
+        except (OSError, ValueError, InstallError) as e:
+            log(f"Invalid manifest: {e}", "error")
+            exit(1)
+
+        for st in sites:
+            if args.wp_version:
+                st.setdefault("version", args.wp_version)
+            if args.locale:
+                st.setdefault("locale", args.locale)
+            if args.template:
+                st.setdefault("template", True)
+            st["plugins"] = args.plugin + st.get("plugins", [])
+            st["themes"] = args.theme + st.get("themes", [])
+
+        print(f"📋 Installing {len(sites)} sites with {args.jobs} workers\n")
+        inventory = Inventory(_inventoryFile(args)) if os.path.exists(_inventoryFile(args)) else None
+        results = runManifest(sites, cache, args.jobs, args.segments, args.deploy, args.workers, args.remote_salts, inventory, policy)
+        print()
+        printResults(results)
+        exit(0 if all(r["status"] == "ok" for r in results) else 1)
+
+    # Network phases run while the database and the install path are set up
+    release_f = background(prepareRelease, cache, args.locale, args.segments, args.deploy, args.workers, args.wp_version)
+    keys_f = background(fetchSecurityKeys, None, args.remote_salts)
+
+    print(f"🌐 Wordpress Setup\n")
+
+    if args.path == None:
+        ipath = askText(f"WP Installation path", "./")
+    else:
+        ipath = args.path
+    
+
+
+    sync = False
+    while True:
+        aipath = os.path.abspath(ipath)
+        print(f"Installation path: {aipath}")
+
+        if not os.path.exists(aipath):
+            os.makedirs(aipath, exist_ok=True)
+            print(f"Created directory")
+        else:
+            ctn = os.listdir(aipath)
+            wnb = wpMarkerCount(ctn)
+
+            r = False
+            for htd in ["public_html", "html"]:
+                if htd in ctn:
+                    r = askBool(f"Did you mean to use the '{htd}' directory ?", True)
+                    if r:
+                        ipath = os.path.join(ipath, "public_html")
+                        break
+            if r:
+                continue
+
+            if wnb>2:
+                r = askChoice("The selected directory appears to already contain a WP installation.\nWhat do you wish to do ?", [
                     "Cancel installation",
                     "Keep installation and rewrite wp-config",
                     "Keep installation and update the database config",
@@ -708,6 +4035,10 @@ if __name__=="__main__":
                 elif r==3:
                     print(f"Overwriting WP Installation")
                     break
+                elif r==4:
+                    print(f"Updating the WordPress core, wp-config.php and wp-content are kept")
+                    sync = True
+                    break
                 else:
                     print(f"This option is not yet available\n")
                     exit()
@@ -725,48 +4056,128 @@ if __name__=="__main__":
                 else:
                     break
             break
+
+    # A core update keeps wp-config.php, and with it the site's database
+    journal = None
+    if not sync:
+        print(f"\n\n🗃️ Database Setup")
+
+        if args.name == None:
+            dbExists = askBool("Est-ce la base de données existe déjà ?", default=False)
+            if dbExists:
+                while True:
+                    db_host = askText("Hôte", default="localhost")
+                    db_user = askText("Utilisateur")
+                    db_pass = askText("Mot de passe")
+
+                    r = checkDbConnection(db_host, db_user, db_pass)
+                    if r:
+                        break
+                    else:
+                        print(f"Connection to database failed")
+            else:
+                name = askText("Nom du projet")
+        else:
+            name = args.name
+            dbExists=False
     
-    
+        if not dbExists:
+            db_host = "localhost"
+
+            if not args.nodb:
+                try:
+                    dbl = listDb()
+                except DbError as e:
+                    log(str(e), "error")
+                    exit()
+
+                name = formatName(name)
+                try:
+                    dbn = siteDbName(name)
+                except InstallError as e:
+                    log(str(e), "error")
+                    exit()
+                # The database of an interrupted install of the same site is resumed
+                journal = InstallJournal(aipath, cache.root, f"{name}\n{dbn}")
+                if journal.finished():
+                    journal.reset()
+
+                if journal.has("db"):
+                    print(f"Resuming the database '{dbn}' of an interrupted install")
+                elif dbn in dbl:
+                    print(f"There's already a database named '{dbn}'")
+                    r = askBool("Do you want to replace it and the associated user ?", default=False)
+                    if r:
+                        print(f"Dropping database '{dbn}' and its user\n")
+                        try:
+                            dropDb(dbn, dbn)
+                        except DbError as e:
+                            log(str(e), "error")
+                            exit()
+                    else:
+                        print("Cancelling Installation\n")
+                        exit()
+
+                print(f"Creating objects for projet '{name}'")
+
+                try:
+                    db_pass = createDb(dbn, dbn, journal=journal)
+                except InstallError as e:
+                    log(str(e), "error")
+                    exit()
+
     print(f"\nInstalling WP in {aipath}")
 
-    wpv = getWpVersion()
-    if wpv is None:
-        log("Failed to fetch WordPress version information", "error")
+    print("Fetching Wordpress 📥")
+    try:
+        release = release_f.result()
+    except Exception as e:
+        log(f"      Failed to download Wordpress: {e}", "error")
         exit()
-    
-    print(f"\nLast Wordpress version: {wpv['version']}")
-
-    wpfn = f"/tmp/wp_{wpv['version']}.zip"
 
-    if os.path.exists(wpfn):
-        print("Wordpress archive already exists, skipping download")
-    else:
-        print("Downloading Wordpress 📥", end="", flush=True)
-        r = requests.get(wpv['dlink'])
+    print(f"\nLast Wordpress version: {release['wpv']['version']}")
 
-        if r.status_code != 200:
-            log(f"      Failed to download Wordpress from {wpv['dlink']}", "error")
-            exit()
-        
-        with open(wpfn, "wb") as f:
-            f.write(r.content)
+    if release["downloaded"]:
         print(f"    Wordpress downloaded ✅")
+    else:
+        print("    Wordpress archive found in cache, skipping download")
+    if release.get("language"):
+        print(f"    No {release['language']['locale']} build, using the cached language pack")
     
+    if sync:
+        print(f"\nUpdating Wordpress 🔄")
+        installed = readWpVersion(aipath)
+        old = cache.get(installed, release["wpv"]["locale"]) if installed else None
+        old_files = None
+        if old:
+            with zipfile.ZipFile(old) as zf:
+                old_files = {n[len("wordpress/"):].replace("/", os.sep) for n in zf.namelist() if n.startswith("wordpress/") and not n.endswith("/")}
+
+        st = syncCore(release["tree"] or cache.tree(release["archive"], workers=args.workers), aipath, old_files, args.workers)
+        print(f"    {st['updated']} updated, {st['added']} added, {st['deleted']} deleted and {st['unchanged']} unchanged files ({st['bytes'] // 1024} KiB written)")
+        if policy is not None:
+            st = applyPolicy(aipath, policy, args.workers)
+            print(f"    {st['chown']} chowned and {st['chmod']} chmoded entries, {st['linked']} hardlinked files left alone")
+        print(f"\nUpdate is done 🪄\n")
+        exit()
+
     print(f"\nExtracting Wordpress 📦")
     try:
-        with zipfile.ZipFile(wpfn, 'r') as zipf:
-            zipf.extractall("/tmp")
-        
         if os.path.exists(aipath):
             shutil.rmtree(aipath)
-        os.makedirs(aipath, exist_ok=True)
-        
-        shutil.copytree('/tmp/wordpress', aipath, dirs_exist_ok=True)
+
+        print(f"    {deployRelease(release, aipath, args.deploy, args.workers, policy)}")
     except zipfile.BadZipFile:
         raise Exception(f"❌ Fichier ZIP corrompu")
     except Exception as e:
         raise Exception(f"❌ Erreur lors de l'extraction: {e}")
 
+    specs = sitePackages({"plugins": args.plugin, "themes": args.theme})
+    if specs:
+        print(f"\nInstalling plugins and themes 🧩")
+        for pkg in installPackages(aipath, specs, PackageCache(cache.root), args.workers, policy):
+            print(f"    {pkg}")
+
     print(f"\nWriting configuration 🎚️")
 
     db_conf = {
@@ -779,12 +4190,25 @@ if __name__=="__main__":
     print(db_conf)
 
     writeWpConfig(aipath, db_conf, {
+        "custom_constants": {"WPLANG": release["language"]["locale"]} if release.get("language") else {}
+    }, False, keys_f.result())
 
-    }, False)
+    if policy is not None:
+        applyPolicy(aipath, policy, args.workers, only=("wp-config.php",) + policy.writable)
 
+    if journal is not None:
+        journal.finish()
     print(f"\nInstallation is done 🪄\n")
 
-        
+def main(argv=None):
+    args = buildParser().parse_args(_legacyArgv(sys.argv[1:] if argv is None else list(argv)))
 
-        
+    if args.profile or args.trace:
+        TRACER.enable()
+        atexit.register(reportProfile, args.profile, args.trace)
 
+    configureDbAdmin(option_file=args.db_admin_cnf, unix_socket=args.db_admin_socket, pool_size=max(4, args.jobs))
+    args.func(args)
+
+if __name__=="__main__":
+    main()